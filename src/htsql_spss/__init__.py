@@ -2,34 +2,65 @@
 # Copyright (c) 2016, Prometheus Research, LLC
 #
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
+import atexit
+import collections
 import datetime
+import email.utils
+import hashlib
+import itertools
+import json
+import logging
 import math
+import multiprocessing
 import os
-import re
-import savReaderWriter
+import sys
 import tempfile
+import threading
+import time
+import wsgiref.util
 
 from htsql.core.adapter import Adapter, adapt, adapt_many, call
-from htsql.core.addon import Addon
-from htsql.core.cmd.summon import SummonFormat
+from htsql.core.addon import Addon, Parameter
+from htsql.core.application import Environment
+from htsql.core.context import context
+from htsql.core.cmd.act import Act, RenderFormat, RenderAction, act, \
+    analyze, produce
+from htsql.core.cmd.command import Command, DefaultCmd, FetchCmd, FormatCmd
+from htsql.core.cmd.fetch import RowStream, FetchPipe
+from htsql.core.cmd.summon import Summon, SummonFormat
+from htsql.core.connect import transaction, unscramble, Unscramble, \
+    CursorProxy
+from htsql.core.error import HTTPError, Error, NotFoundError, \
+    PermissionError, InternalServerError, recognize_guard
 from htsql.core.fmt.accept import Accept
 from htsql.core.fmt.format import Format
-from htsql.core.fmt.emit import EmitHeaders, Emit
+from htsql.core.fmt.emit import EmitHeaders, Emit, emit_headers, emit
 from htsql.core.domain import Domain, BooleanDomain, NumberDomain, \
     FloatDomain, DecimalDomain, TextDomain, EnumDomain, DateDomain, \
     TimeDomain, DateTimeDomain, ListDomain, RecordDomain, UntypedDomain, \
-    VoidDomain, IntegerDomain, IdentityDomain, Profile
+    VoidDomain, IntegerDomain, IdentityDomain, Profile, Product
 from htsql.core.util import listof
-from .stopwords import STOPWORDS
+from htsql.core.syn.syntax import StringSyntax
+from htsql.core.validator import BoolVal, UIntVal, ChoiceVal, StrVal
+from htsql.core.wsgi import wsgi
+from .cache import ResultCache, check_directory
+from .jobs import ExportQueue
+from .naming import UniqueNames, make_column_id
+from .spool import SpoolFile, SpoolQuota, SpoolQuotaError
+from .timing import ExportTimings
+from .writer import SAVWriter, ZSAVWriter, ColumnMemo, EncodingError, \
+    check_var_name
 
 
 SPSS_MAX_STRING_LENGTH = 32767
 SPSS_MIME_TYPE = 'application/x-spss-sav'
+ZSAV_MIME_TYPE = 'application/x-spss-zsav'
+SPSS_CHUNK_SIZE = 64*1024
+SPSS_BATCH_SIZE = 1024
+SPSS_FETCH_SIZE = 10000
+SPSS_FILE_BODY_KEY = 'htsql_spss.file_body'
+SPSS_SYSMIS = -sys.float_info.max
+SPSS_LOGGER = logging.getLogger('htsql_spss')
 SPSS_GREGORIAN_OFFSET = (datetime.datetime.fromtimestamp(0) - datetime.datetime(1582, 10, 14)).total_seconds()
 
 
@@ -37,6 +68,158 @@ class SPSSAddon(Addon):
     name = 'htsql_spss'
     hint = 'Basic support for IBM SPSS files'
 
+    # Parameters changing the output must be added to the cache key in
+    # `RenderSPSS.cache_key()`.
+    parameters = [
+        Parameter('schema_widths', BoolVal(), default=False,
+                  hint="take string widths from the schema when known"),
+        Parameter('layout_cache_size', UIntVal(), default=128,
+                  hint="number of compiled variable layouts to keep"),
+        Parameter('writer', ChoiceVal(['savreaderwriter', 'native']),
+                  default='savreaderwriter',
+                  hint="backend that writes .sav files"),
+        Parameter('compression', ChoiceVal(['none', 'bytecode']),
+                  default='bytecode',
+                  hint="compression of the case data"),
+        Parameter('fetch_size', UIntVal(), default=0,
+                  hint="stream flat results from the database in batches"
+                       " of this many rows (0 to disable)"),
+        Parameter('zsav_threads', UIntVal(), default=0,
+                  hint="number of threads compressing .zsav output"
+                       " (0 for one per CPU)"),
+        Parameter('export_workers', UIntVal(), default=2,
+                  hint="number of asynchronous exports rendered at once"),
+        Parameter('export_retention', UIntVal(), default=3600,
+                  hint="seconds to keep the output of asynchronous exports"),
+        Parameter('spool_directory', StrVal(is_nullable=True), default=None,
+                  hint="directory for rendered files and the output of"
+                       " asynchronous exports"),
+        Parameter('spool_quota', UIntVal(), default=0,
+                  hint="megabytes of rendered files to keep in the spool"
+                       " at once (0 for no limit)"),
+        Parameter('spool_preallocate', BoolVal(), default=False,
+                  hint="reserve the expected size of files written by"
+                       " the native writer"),
+        Parameter('result_cache_size', UIntVal(), default=0,
+                  hint="megabytes of rendered files to cache (0 to disable)"),
+        Parameter('data_version', StrVal(is_nullable=True), default=None,
+                  hint="SQL query returning the version of the data"),
+        Parameter('export_processes', UIntVal(), default=0,
+                  hint="number of processes encoding wide files by column"
+                       " groups (0 to disable)"),
+        Parameter('column_group_size', UIntVal(), default=256,
+                  hint="least number of variables in a column group"),
+        Parameter('shard_size', UIntVal(), default=0,
+                  hint="number of cases in the row shards encoded on the"
+                       " process pool (0 to disable)"),
+        Parameter('timing_hook', StrVal(is_nullable=True), default=None,
+                  hint="function called with the phase timings of every"
+                       " export (module.function)"),
+        Parameter('server_timing', BoolVal(), default=False,
+                  hint="report phase timings in a Server-Timing header"),
+        Parameter('coded_values', BoolVal(), default=False,
+                  hint="write enums and booleans as numeric codes"
+                       " with value labels"),
+    ]
+
+    def __init__(self, app, attributes):
+        super(SPSSAddon, self).__init__(app, attributes)
+        self.layout_cache = LayoutCache(self.layout_cache_size)
+        self.spool_usage = SpoolQuota(self.spool_quota * 1024 * 1024)
+        cache_directory = None
+        jobs_directory = None
+        if self.spool_directory is not None:
+            cache_directory = os.path.join(self.spool_directory,
+                                           'htsql_spss-cache')
+            jobs_directory = os.path.join(self.spool_directory,
+                                          'htsql_spss-jobs')
+        self.export_queue = ExportQueue(self.export_workers,
+                                        self.export_retention,
+                                        jobs_directory, self.spool_usage)
+        self.result_cache = ResultCache(cache_directory,
+                                        self.result_cache_size * 1024 * 1024)
+        self.encoder_pool = None
+        self.lock = threading.Lock()
+        self.timing_callback = None
+
+    def validate(self):
+        if self.timing_hook is not None:
+            module_name, _, function_name = self.timing_hook.rpartition('.')
+            try:
+                module = __import__(module_name, fromlist=[function_name])
+                self.timing_callback = getattr(module, function_name)
+            except (ImportError, AttributeError, ValueError):
+                raise ValueError("cannot find timing hook %r"
+                                 % self.timing_hook)
+        if self.result_cache_size and self.result_cache.directory and \
+                os.path.exists(self.result_cache.directory):
+            check_directory(self.result_cache.directory)
+        if self.export_queue.directory is not None and \
+                os.path.exists(self.export_queue.directory):
+            # Sweeps the output of asynchronous exports left by previous
+            # processes.
+            with self.export_queue.lock:
+                self.export_queue.prepare()
+
+    def get_encoder_pool(self):
+        # The worker processes are forked on the first export using them
+        # and stopped by `close()` or when the process exits.
+        with self.lock:
+            if self.encoder_pool is None:
+                self.encoder_pool = multiprocessing.Pool(
+                        self.export_processes)
+                atexit.register(self.encoder_pool.terminate)
+            return self.encoder_pool
+
+    def close(self):
+        """
+        Stops the worker processes encoding files; the next export using
+        them starts them again.
+        """
+        with self.lock:
+            encoder_pool = self.encoder_pool
+            self.encoder_pool = None
+        if encoder_pool is not None:
+            encoder_pool.close()
+            encoder_pool.join()
+
+
+class LayoutCache(object):
+    """
+    A thread-safe LRU cache of compiled variable layouts and flattening
+    plans.
+
+    Entries are keyed by the signature of the adapter tree they were
+    compiled from; `hits` and `misses` count cache lookups.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                value = self.entries.pop(key)
+                self.entries[key] = value
+                return value
+            self.misses += 1
+        value = compile()
+        if self.size:
+            with self.lock:
+                self.entries[key] = value
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 
 class ToSPSS(Adapter):
     adapt(Domain)
@@ -47,60 +230,108 @@ class ToSPSS(Adapter):
         self.domain = domain
         self.profiles = profiles
         self.width = 1
+        # Whether the variables need a pass over the data to find their widths.
+        self.is_measured = False
+        # The flattening plan of the adapter tree and its scalar adapters.
+        self.plan = None
+        self.leaves = None
 
     def sav_config(self, data):
+        layout_cache = context.app.htsql_spss.layout_cache
+        layout = layout_cache.get(self.signature(), self.checked_layout)
+        widths = [1] * self.width
+        if self.is_measured:
+            self.measure(data, widths, 0)
+
         sav_config = {}
         sav_config['var_names'] = []
         sav_config['var_types'] = {}
         sav_config['formats'] = {}
         sav_config['column_widths'] = {}
+        sav_config['value_labels'] = {}
+        for (var_name, var_type, var_format), width in zip(layout, widths):
+            if var_type is None:
+                var_type = min(width, SPSS_MAX_STRING_LENGTH)
+                var_format = 'A' + str(var_type)
+            sav_config['var_names'].append(var_name)
+            sav_config['var_types'][var_name] = var_type
+            sav_config['formats'][var_name] = var_format
+            sav_config['column_widths'][var_name] = 10
+        if context.app.htsql_spss.coded_values:
+            for var_name, labels in zip(sav_config['var_names'],
+                                        self.value_labels()):
+                if labels:
+                    sav_config['value_labels'][var_name] = labels
         return sav_config
 
     def __call__(self):
         return self
 
+    def signature(self):
+        # Identifies the layout produced by the adapter.
+        return (self.__class__, self.domain, self.column_source())
+
+    def layout(self):
+        # A list of `(var_name, var_type, var_format)` triples, one for each
+        # variable; `var_type` is `None` for strings measured from the data.
+        return []
+
+    def checked_layout(self):
+        # The layout, once its names are checked the way both writers
+        # would check them.
+        layout = self.layout()
+        for var_name, var_type, var_format in layout:
+            try:
+                check_var_name(var_name)
+            except ValueError:
+                raise Error("Got an invalid SPSS variable name", var_name)
+        return layout
+
+    def value_labels(self):
+        # For every variable, a dictionary of its codes and their labels
+        # or `None`.
+        return [None] * self.width
+
+    def measure(self, data, widths, offset):
+        pass
+
+    def measure_column(self, values, widths, offset):
+        # Measures a column of values of a scalar domain.
+        for value in values:
+            self.measure(value, widths, offset)
+
+    def count(self, data):
+        # The number of rows `cells()` produces for the data.
+        return 1
+
     def cells(self, data):
         raise NotImplementedError
 
-    def widths(self, data):
-        if data is None:
-            dumped = ''
-        else:
-            dumped = self.domain.dump(data)
-        length = len(dumped)
+    def convert(self, values):
+        # Converts a column of values of a scalar domain to cell values.
+        return [cell for value in values for [cell] in self.cells(value)]
 
-        if length == 0:
-            # SPSS format does not allow 0-length string columns
-            length = 1
+    def flatten(self, values):
+        # Produces the rows for a batch of values.
+        if self.plan is None:
+            layout_cache = context.app.htsql_spss.layout_cache
+            self.plan = layout_cache.get((FlatteningPlan, self.signature()),
+                                         lambda: FlatteningPlan(self))
+            self.leaves = self.plan.leaves(self)
+        return self.plan.flatten(values, self.leaves)
 
-        return [length]
-
-    def column_id(self, data):
+    def column_source(self):
         profile = self.profiles[-1]
 
         if profile.path:
-            column_id = profile.path[-1].table.name + '.' + profile.path[-1].column.name
+            return profile.path[-1].table.name + '.' + profile.path[-1].column.name
         elif profile.header:
-            column_id = profile.header
+            return profile.header
         else:
-            column_id = profile.tag
-        # sanitize all non-legal characters
-        column_id = re.sub('[^a-zA-Z0-9._$#@]', '_', column_id)
-        if len(column_id) > 63:
-            column_id = self.cut_column_name(column_id)
-        return column_id
-
-    def cut_column_name(self, column_id):
-        table_name, column_name = column_id.split('.')
-        column_name = column_name.split('_')
-        column_name = '_'.join([word for word in column_name
-                                     if word not in STOPWORDS])
-        column_id = column_name
-        if table_name:
-            column_id = table_name + '.' + column_id
-        if len(column_id) > 63:
-            column_id = column_id[:62]
-        return column_id
+            return profile.tag
+
+    def column_id(self):
+        return make_column_id(self.column_source())
 
 
 class RecordToSPSS(ToSPSS):
@@ -113,72 +344,74 @@ class RecordToSPSS(ToSPSS):
             for field in domain.fields
         ]
         self.width = 0
-        for field_to_spss in self.fields_to_spss:
+        self.measured_fields = []
+        for idx, field_to_spss in enumerate(self.fields_to_spss):
+            if field_to_spss.is_measured:
+                self.measured_fields.append((idx, field_to_spss, self.width))
             self.width += field_to_spss.width
+        self.is_measured = bool(self.measured_fields)
+        # Whether all fields are scalars, so records could be converted
+        # column by column.
+        self.is_flat = all(
+            not isinstance(field_to_spss, (RecordToSPSS, ListToSPSS))
+            for field_to_spss in self.fields_to_spss)
+
+    def signature(self):
+        return (self.__class__,
+                tuple(field_to_spss.signature()
+                      for field_to_spss in self.fields_to_spss))
+
+    def layout(self):
+        layout = []
+        var_names = UniqueNames()
+        for field_to_spss in self.fields_to_spss:
+            for var_name, var_type, var_format in field_to_spss.layout():
+                layout.append((var_names.allocate(var_name),
+                               var_type, var_format))
+        return layout
+
+    def value_labels(self):
+        return [labels for field_to_spss in self.fields_to_spss
+                       for labels in field_to_spss.value_labels()]
 
-    def sav_config(self, record):
-        sav_config = super(RecordToSPSS, self).sav_config(record)
+    def measure(self, record, widths, offset):
         if record is None:
-            record = [None]*self.width
-
-        for item, field_to_spss in zip(record, self.fields_to_spss):
-            field_sav_config = field_to_spss.sav_config(item)
-            for var_name in field_sav_config['var_names']:
-                if var_name in sav_config['var_names']:
-                    new_var_name = self.make_unique_name(var_name, sav_config['var_names'])
-                    var_name_idx = field_sav_config['var_names'].index(var_name)
-                    field_sav_config['var_names'][var_name_idx] = new_var_name
-                    field_sav_config['var_types'][new_var_name] = field_sav_config['var_types'].pop(var_name)
-                    field_sav_config['formats'][new_var_name] = field_sav_config['formats'].pop(var_name)
-                    field_sav_config['column_widths'][new_var_name] = field_sav_config['column_widths'].pop(var_name)
-            sav_config['var_names'].extend(field_sav_config['var_names'])
-            sav_config['var_types'].update(field_sav_config['var_types'])
-            sav_config['formats'].update(field_sav_config['formats'])
-            sav_config['column_widths'].update(field_sav_config['column_widths'])
-        return sav_config
+            return
+        for idx, field_to_spss, field_offset in self.measured_fields:
+            field_to_spss.measure(record[idx], widths, offset + field_offset)
 
-    def make_unique_name(self, var_name, var_names, idx=1):
-        if len(var_name) + len(str(idx)) >  63:
-            var_name = var_name[:63-len(str(idx))]
-            idx = 1
-        if var_name not in var_names:
-            return var_name
-        new_var_name = var_name + '_' + str(idx)
-        while new_var_name in var_names:
-            new_var_name = self.make_unique_name(var_name, var_names, idx+1)
-        return new_var_name
+    def measure_columns(self, columns, widths, offset):
+        # Measures flat records given as columns of field values.
+        for idx, field_to_spss, field_offset in self.measured_fields:
+            field_to_spss.measure_column(columns[idx], widths,
+                                         offset + field_offset)
+
+    def count(self, record):
+        if not self.width:
+            return 0
+        if record is None:
+            return 1
+        return max(field_to_spss.count(field_value)
+                   for field_value, field_to_spss
+                   in zip(record, self.fields_to_spss))
 
     def cells(self, record):
         if not self.width:
             return
-        if record is None:
-            yield [None] * self.width
-        else:
-            cell_streams = [
-                (field_to_spss.cells(field_value), field_to_spss.width)
-                for field_value, field_to_spss in zip(record, self.fields_to_spss)
-            ]
-            is_done = False
-            while not is_done:
-                is_done = True
-                row = []
-                for cell_stream, field_width in cell_streams:
-                    subrow = next(cell_stream, None)
-                    if subrow is None:
-                        subrow = [None] * field_width
-                    else:
-                        is_done = False
-                    row.extend(subrow)
-                if not is_done:
-                    yield row
-
-    def widths(self, data):
-        widths = []
-        if data is None:
-            data = [None]*self.width
-        for item, field_to_spss in zip(data, self.fields_to_spss):
-            widths += field_to_spss.widths(item)
-        return widths
+        for row in self.flatten([record]):
+            yield row
+
+    def column_cells(self, batches):
+        # Produces the rows of flat records given as batches of columns
+        # of field values; every column is converted at once.
+        fields = [(idx, field_to_spss)
+                  for idx, field_to_spss in enumerate(self.fields_to_spss)
+                  if field_to_spss.width]
+        for columns in batches:
+            cells = [field_to_spss.convert(columns[idx])
+                     for idx, field_to_spss in fields]
+            for row in itertools.izip(*cells):
+                yield row
 
 
 class ListToSPSS(ToSPSS):
@@ -188,104 +421,305 @@ class ListToSPSS(ToSPSS):
         super(ListToSPSS, self).__init__(domain, profiles)
         self.item_to_spss = to_spss(domain.item_domain, profiles)
         self.width = self.item_to_spss.width
+        self.is_measured = self.item_to_spss.is_measured
 
-    def sav_config(self, list_value):
-        sav_config = self.item_to_spss.sav_config(None)
-        lagest_width = {}
-        if list_value:
-            for item in list_value:
-                item_sav_config = self.item_to_spss.sav_config(item)
-                item_width = self.item_to_spss.widths(item)
-                for (idx, var_name) in enumerate(item_sav_config['var_names']):
-                    if var_name not in sav_config['var_names']:
-                        sav_config['var_names'].append(var_name)
-                    var_width = item_width[idx]
-                    max_var_width = lagest_width.get(var_name, 0)
-                    if var_width > max_var_width:
-                        lagest_width[var_name] = var_width
-                        sav_config['var_types'][var_name] = item_sav_config['var_types'][var_name]
-                        sav_config['formats'][var_name] = item_sav_config['formats'][var_name]
-                        sav_config['column_widths'][var_name] = item_sav_config['column_widths'][var_name]                    
-        return sav_config
+    def signature(self):
+        return (self.__class__, self.item_to_spss.signature())
+
+    def layout(self):
+        return self.item_to_spss.layout()
+
+    def value_labels(self):
+        return self.item_to_spss.value_labels()
+
+    def measure(self, list_value, widths, offset):
+        if not list_value:
+            return
+        if isinstance(list_value, FetchedColumns):
+            self.item_to_spss.measure_columns(list_value.columns,
+                                              widths, offset)
+            return
+        item_measure = self.item_to_spss.measure
+        for item in list_value:
+            item_measure(item, widths, offset)
+
+    def count(self, list_value):
+        if isinstance(list_value, FetchStream):
+            # Streamed records are not counted in advance.
+            return -1
+        if not self.width or not list_value:
+            return 0
+        if isinstance(self.item_to_spss, RecordToSPSS) and \
+                self.item_to_spss.is_flat:
+            return len(list_value)
+        item_count = self.item_to_spss.count
+        return sum(item_count(item) for item in list_value)
 
     def cells(self, list_value):
         if not self.width:
             return
-        if list_value is not None:
-            item_to_cells = self.item_to_spss.cells
-            for item in list_value:
-                for cell in item_to_cells(item):
-                    yield cell
-
-    def widths(self, data):
-        widths = [0]*self.width
-        if not data:
-            data = [None]
-        for item in data:
-            widths = [max(width, item_width)
-                      for width, item_width
-                            in zip(widths, self.item_to_spss.widths(item))]
-        return widths
+        if list_value is None:
+            return
+        if isinstance(list_value, FetchedColumns) or \
+                (isinstance(list_value, FetchStream) and
+                 list_value.field_columns is not None):
+            for row in self.item_to_spss.column_cells(list_value.batches()):
+                yield row
+            return
+        items = iter(list_value)
+        while True:
+            batch = list(itertools.islice(items, SPSS_BATCH_SIZE))
+            if not batch:
+                break
+            for row in self.item_to_spss.flatten(batch):
+                yield row
+
+
+class FlatteningPlan(object):
+    """
+    An adapter tree compiled to produce rows without nested generators.
+
+    Every record, list and scalar of the tree is compiled into a function
+    that, for a value, copies the row template for each row the value
+    spans and registers the scalars with the row and the column they
+    fill.  The scalars are then converted a whole column at a time by
+    the scalar adapters of the tree, given to `flatten()`, so that a plan
+    could be shared by the adapter trees of the same signature.
+    """
+
+    def __init__(self, to_spss):
+        self.template = [None] * to_spss.width
+        # The column of every scalar, in the order of `leaves()`.
+        self.columns = []
+        self.fill = self.compile(to_spss, 0)
+
+    def leaves(self, to_spss):
+        # The scalar adapters of the tree, in the order they were compiled.
+        if isinstance(to_spss, RecordToSPSS):
+            return [leaf_to_spss
+                    for field_to_spss in to_spss.fields_to_spss
+                    if field_to_spss.width
+                    for leaf_to_spss in self.leaves(field_to_spss)]
+        if isinstance(to_spss, ListToSPSS):
+            return self.leaves(to_spss.item_to_spss)
+        return [to_spss]
+
+    def flatten(self, values, leaves):
+        # Produces the rows for a batch of values.
+        rows = []
+        base = 0
+        fill = self.fill
+        leaf_values = [[] for column in self.columns]
+        leaf_rows = [[] for column in self.columns]
+        for value in values:
+            base += fill(value, rows, base, leaf_values, leaf_rows)
+        for column, leaf_to_spss, column_values, column_rows in zip(
+                self.columns, leaves, leaf_values, leaf_rows):
+            if column_values:
+                cells = leaf_to_spss.convert(column_values)
+                for row, cell in zip(column_rows, cells):
+                    row[column] = cell
+        return rows
+
+    def compile(self, to_spss, offset):
+        # Returns a function `fill(value, rows, base, leaf_values,
+        # leaf_rows)` that fills the rows of the value starting from
+        # `rows[base]`, adds its scalars to the lists of their leaves and
+        # returns the number of rows.
+        template = self.template
+
+        def get_row(rows, index):
+            while len(rows) <= index:
+                rows.append(template[:])
+            return rows[index]
+
+        if isinstance(to_spss, RecordToSPSS):
+            leaves = []
+            composites = []
+            field_offset = offset
+            for idx, field_to_spss in enumerate(to_spss.fields_to_spss):
+                if not field_to_spss.width:
+                    continue
+                if isinstance(field_to_spss, (RecordToSPSS, ListToSPSS)):
+                    composites.append(
+                            (idx, self.compile(field_to_spss, field_offset)))
+                else:
+                    leaves.append((idx, len(self.columns)))
+                    self.columns.append(field_offset)
+                field_offset += field_to_spss.width
+            if not to_spss.width:
+                return lambda record, rows, base, leaf_values, leaf_rows: 0
+
+            def fill_record(record, rows, base, leaf_values, leaf_rows):
+                if record is None:
+                    get_row(rows, base)
+                    return 1
+                count = 0
+                if leaves:
+                    row = get_row(rows, base)
+                    for idx, leaf in leaves:
+                        leaf_values[leaf].append(record[idx])
+                        leaf_rows[leaf].append(row)
+                    count = 1
+                for idx, fill_field in composites:
+                    field_count = fill_field(record[idx], rows, base,
+                                             leaf_values, leaf_rows)
+                    if field_count > count:
+                        count = field_count
+                return count
+            return fill_record
+
+        if isinstance(to_spss, ListToSPSS):
+            fill_item = self.compile(to_spss.item_to_spss, offset)
+
+            def fill_list(list_value, rows, base, leaf_values, leaf_rows):
+                if not list_value:
+                    return 0
+                count = 0
+                for item in list_value:
+                    count += fill_item(item, rows, base + count,
+                                       leaf_values, leaf_rows)
+                return count
+            return fill_list
+
+        leaf = len(self.columns)
+        self.columns.append(offset)
+
+        def fill_leaf(value, rows, base, leaf_values, leaf_rows):
+            leaf_values[leaf].append(value)
+            leaf_rows[leaf].append(get_row(rows, base))
+            return 1
+        return fill_leaf
 
 
 class SimpleToSPSS(ToSPSS):
     adapt_many(
         UntypedDomain,
         TextDomain,
-        EnumDomain,
         IdentityDomain
     )
 
-    def sav_config(self, data):
-        sav_config = {}
+    def __init__(self, domain, profiles):
+        super(SimpleToSPSS, self).__init__(domain, profiles)
+        self.schema_width = None
+        if context.app.htsql_spss.schema_widths:
+            self.schema_width = self.find_schema_width()
+        self.is_measured = (self.schema_width is None)
+        # Values serialized while measuring, reused when generating cells;
+        # a bounded memo dropped for columns of mostly distinct values.
+        self.dumps = ColumnMemo(self.domain.dump)
+
+    def find_schema_width(self):
+        if isinstance(self.domain, EnumDomain):
+            return max([len(label) for label in self.domain.labels] + [1])
+        if isinstance(self.domain, TextDomain) and self.domain.length:
+            return min(self.domain.length, SPSS_MAX_STRING_LENGTH)
+        return None
+
+    def layout(self):
+        if self.schema_width is not None:
+            return [(self.column_id(), self.schema_width,
+                     'A' + str(self.schema_width))]
+        return [(self.column_id(), None, None)]
+
+    def dump(self, value):
+        return self.dumps.get(value)
+
+    def measure(self, value, widths, offset):
+        if value is None:
+            return
+        length = len(self.dump(value))
+        if length > widths[offset]:
+            widths[offset] = length
 
-        column_id = self.column_id(data)
-        max_len = self.widths(data)[0]
-        max_len = min(max_len, SPSS_MAX_STRING_LENGTH)
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: max_len}
-        sav_config['formats'] = {column_id: 'A' + str(max_len)}
-        sav_config['column_widths'] = {column_id: 10}
+    def measure_column(self, values, widths, offset):
+        for start in range(0, len(values), SPSS_BATCH_SIZE):
+            lengths = map(len, filter(None, self.dumps(
+                    values[start:start+SPSS_BATCH_SIZE])))
+            if lengths and max(lengths) > widths[offset]:
+                widths[offset] = max(lengths)
 
-        return sav_config
+    def cells(self, value):
+        yield [self.dump(value)]
+
+    def convert(self, values):
+        return self.dumps(values)
+
+
+class EnumToSPSS(SimpleToSPSS):
+    adapt(EnumDomain)
+
+    def __init__(self, domain, profiles):
+        super(EnumToSPSS, self).__init__(domain, profiles)
+        # With `coded_values`, labels are written as their positions.
+        self.codes = None
+        if context.app.htsql_spss.coded_values:
+            self.codes = dict((label, float(idx + 1))
+                              for idx, label in enumerate(domain.labels))
+            self.is_measured = False
+
+    def layout(self):
+        if self.codes is not None:
+            return [(self.column_id(), 0,
+                     'F' + str(len(str(len(self.domain.labels)))))]
+        return super(EnumToSPSS, self).layout()
+
+    def value_labels(self):
+        if self.codes is not None:
+            return [dict((code, label)
+                         for label, code in self.codes.items())]
+        return [None]
 
     def cells(self, value):
-        yield [self.domain.dump(value)]
+        if self.codes is not None:
+            yield [self.codes.get(value)]
+        else:
+            yield [self.dump(value)]
+
+    def convert(self, values):
+        if self.codes is not None:
+            codes = self.codes
+            return [codes.get(value) for value in values]
+        return super(EnumToSPSS, self).convert(values)
 
 
 class BooleanToSPSS(ToSPSS):
     adapt(BooleanDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
+    def __init__(self, domain, profiles):
+        super(BooleanToSPSS, self).__init__(domain, profiles)
+        # With `coded_values`, booleans are written as 1 and 0.
+        self.is_coded = context.app.htsql_spss.coded_values
 
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 5}
-        sav_config['formats'] = {column_id: 'A5'}
-        sav_config['column_widths'] = {column_id: 10}
+    def layout(self):
+        if self.is_coded:
+            return [(self.column_id(), 0, 'F1')]
+        return [(self.column_id(), 5, 'A5')]
 
-        return sav_config
+    def value_labels(self):
+        if self.is_coded:
+            return [{1.0: self.domain.dump(True),
+                     0.0: self.domain.dump(False)}]
+        return [None]
 
     def cells(self, value):
-        yield [self.domain.dump(value)]
+        if self.is_coded:
+            yield [None if value is None else float(value)]
+        else:
+            yield [self.domain.dump(value)]
+
+    def convert(self, values):
+        if self.is_coded:
+            return [None if value is None else float(value)
+                    for value in values]
+        return super(BooleanToSPSS, self).convert(values)
 
 
 class IntegerToSPSS(ToSPSS):
     adapt(IntegerDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'F40'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'F40')]
 
     def cells(self, value):
         if value is None:
@@ -293,21 +727,16 @@ class IntegerToSPSS(ToSPSS):
         else:
             yield [self.domain.dump(value)]
 
+    def convert(self, values):
+        import numpy
+        return to_numbers(numpy.array(values, dtype=numpy.float64))
+
 
 class FloatToSPSS(ToSPSS):
     adapt_many(FloatDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'F40.16'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'F40.16')]
 
     def cells(self, value):
         if value is None or math.isinf(value) or math.isnan(value):
@@ -315,21 +744,16 @@ class FloatToSPSS(ToSPSS):
         else:
             yield [value]
 
+    def convert(self, values):
+        import numpy
+        return to_numbers(numpy.array(values, dtype=numpy.float64))
+
 
 class DecimalToSPSS(ToSPSS):
     adapt(DecimalDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'F40.16'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'F40.16')]
 
     def cells(self, value):
         if value is None or not value.is_finite():
@@ -337,21 +761,16 @@ class DecimalToSPSS(ToSPSS):
         else:
             yield [value]
 
+    def convert(self, values):
+        import numpy
+        return to_numbers(numpy.array(values, dtype=numpy.float64))
+
 
 class DateToSPSS(ToSPSS):
     adapt(DateDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'DATE11'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'DATE11')]
 
     def cells(self, value):
         if value is None:
@@ -360,21 +779,19 @@ class DateToSPSS(ToSPSS):
             unix_timestamp = (value - datetime.date.fromtimestamp(0)).total_seconds()
             yield [unix_timestamp + SPSS_GREGORIAN_OFFSET]
 
+    def convert(self, values):
+        import numpy
+        epoch = numpy.datetime64(datetime.date.fromtimestamp(0), 'D')
+        days = numpy.array(values, dtype='datetime64[D]')
+        seconds = (days - epoch) / numpy.timedelta64(1, 's')
+        return to_numbers(seconds + SPSS_GREGORIAN_OFFSET)
+
 
 class TimeToSPSS(ToSPSS):
     adapt(TimeDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'TIME10'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'TIME10')]
 
     def cells(self, value):
         if value is None:
@@ -384,21 +801,22 @@ class TimeToSPSS(ToSPSS):
             seconds = value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1.0e6
             yield [seconds]
 
+    def convert(self, values):
+        import numpy
+        parts = numpy.array([
+                (value.hour, value.minute, value.second, value.microsecond)
+                if value is not None else (numpy.nan,)*4
+                for value in values], dtype=numpy.float64)
+        if not len(parts):
+            return []
+        return to_numbers(parts.dot([3600.0, 60.0, 1.0, 1.0e-6]))
+
 
 class DateTimeToSPSS(ToSPSS):
     adapt(DateTimeDomain)
 
-    def sav_config(self, data):
-        sav_config = {}
-
-        column_id = self.column_id(data)
-
-        sav_config['var_names'] = [column_id]
-        sav_config['var_types'] = {column_id: 0}
-        sav_config['formats'] = {column_id: 'DATETIME22'}
-        sav_config['column_widths'] = {column_id: 10}
-
-        return sav_config
+    def layout(self):
+        return [(self.column_id(), 0, 'DATETIME22')]
 
     def cells(self, value):
         if value is None:
@@ -407,10 +825,23 @@ class DateTimeToSPSS(ToSPSS):
             unix_timestamp = (value - datetime.datetime.fromtimestamp(0)).total_seconds()
             yield [unix_timestamp + SPSS_GREGORIAN_OFFSET]
 
+    def convert(self, values):
+        import numpy
+        epoch = numpy.datetime64(datetime.datetime.fromtimestamp(0), 'us')
+        moments = numpy.array(values, dtype='datetime64[us]')
+        seconds = (moments - epoch) / numpy.timedelta64(1, 's')
+        return to_numbers(seconds + SPSS_GREGORIAN_OFFSET)
+
 
 to_spss = ToSPSS.__invoke__  # pylint: disable=invalid-name
 
 
+def to_numbers(array):
+    # Maps NaN and infinite values to the system-missing value.
+    import numpy
+    return numpy.where(numpy.isfinite(array), array, SPSS_SYSMIS).tolist()
+
+
 def make_name(meta):
     filename = None
     if meta.header:
@@ -422,7 +853,11 @@ def make_name(meta):
 
 
 class SPSSFormat(Format):
-    pass
+    # Validators of cached output.
+    etag = None
+    last_modified = None
+    # The `ExportTimings` of the export.
+    timings = None
 
 
 class SummonSPSS(SummonFormat):
@@ -453,69 +888,897 @@ class EmitSPSSHeaders(EmitHeaders):
                 self.file_extension,
             ),
         )
+        if self.format.etag is not None:
+            yield ('ETag', self.format.etag)
+        if self.format.last_modified is not None:
+            yield ('Last-Modified',
+                   email.utils.formatdate(self.format.last_modified,
+                                          usegmt=True))
 
 
 class EmitSPSS(Emit):
     adapt(SPSSFormat)
 
     def __call__(self):
+        self.timings = self.format.timings or ExportTimings()
         product = to_spss(self.meta.domain, [self.meta])
-        output = StringIO()
-        self.render(output, product)
-        yield output.getvalue()
+        if self.is_spooled():
+            body = self.spool(product)
+        else:
+            # Configured before the response starts, so that an invalid
+            # variable name gives an error response.
+            body = self.stream(product, self.sav_config(product))
+        return self.report(body)
+
+    def is_spooled(self):
+        # Whether the file is rendered to the spool before it is sent.
+        return not (context.app.htsql_spss.writer == 'native' and
+                    not isinstance(self.data, FetchStream))
+
+    def spool_file(self):
+        # Renders the whole file to the spool; the file is removed once
+        # it is closed.
+        self.timings = self.format.timings or ExportTimings()
+        output_file = self.render_file(to_spss(self.meta.domain,
+                                               [self.meta]))
+        report_timings(self.timings)
+        return output_file
+
+    def report(self, body):
+        # Passes the body through and reports the timings once complete.
+        for chunk in body:
+            yield chunk
+        report_timings(self.timings)
+
+    def stream(self, product, sav_config):
+        # Writes the file with the native writer, yielding the output
+        # after every batch of records.
+        output = ChunkBuffer()
+        writer = SAVWriter(output,
+                           sav_config['var_names'],
+                           sav_config['var_types'],
+                           formats=sav_config['formats'],
+                           column_widths=sav_config['column_widths'],
+                           value_labels=sav_config['value_labels'],
+                           ncases=product.count(self.data),
+                           compression=self.compression(),
+                           **self.parallel_encoding(sav_config))
+        chunk = output.drain()
+        size = len(chunk)
+        yield chunk
+        for batch in self.write_batches(writer, product):
+            chunk = output.drain()
+            size += len(chunk)
+            yield chunk
+        encoding = self.timings.phase('encoding')
+        with encoding:
+            writer.close()
+        chunk = output.drain()
+        encoding.bytes += size + len(chunk)
+        yield chunk
+
+    def sav_config(self, product):
+        with self.timings.phase('sav_config'):
+            return product.sav_config(self.data)
+
+    def write_batches(self, writer, product, output_file=None):
+        # Writes the cells in batches, timing their generation and their
+        # encoding separately; yields after every batch.  The growth of
+        # the spooled `output_file` is charged to the quota.
+        records = product.cells(self.data)
+        cells = self.timings.phase('cells')
+        encoding = self.timings.phase('encoding')
+        while True:
+            with cells:
+                batch = list(itertools.islice(records, SPSS_BATCH_SIZE))
+            if not batch:
+                break
+            cells.rows += len(batch)
+            with encoding:
+                writer.writerows(batch)
+            encoding.rows += len(batch)
+            if output_file is not None:
+                output_file.settle()
+            yield batch
+
+    def compression(self):
+        compression = context.app.htsql_spss.compression
+        if compression == 'none':
+            return None
+        return compression
+
+    def parallel_encoding(self, sav_config):
+        # Wide files are encoded in column groups on a process pool,
+        # others in row shards if `shard_size` is set.
+        addon = context.app.htsql_spss
+        if addon.export_processes < 2:
+            return {}
+        groups = min(addon.export_processes,
+                     len(sav_config['var_names']) //
+                     max(addon.column_group_size, 1))
+        if groups >= 2:
+            return {'pool': addon.get_encoder_pool(), 'groups': groups}
+        if addon.shard_size:
+            return {'pool': addon.get_encoder_pool(),
+                    'shard_size': addon.shard_size,
+                    'shards': 2 * addon.export_processes}
+        return {}
+
+    def spool(self, product):
+        output_file = self.render_file(product)
+        copy = self.timings.phase('copy')
+        with output_file:
+            while True:
+                with copy:
+                    chunk = output_file.read(SPSS_CHUNK_SIZE)
+                if not chunk:
+                    break
+                copy.bytes += len(chunk)
+                yield chunk
+
+    def render_file(self, product):
+        # The file is opened once: written through its descriptor or by
+        # the I/O library by name, then read back through the descriptor.
+        # The I/O library picks the compression from the file name.
+        addon = context.app.htsql_spss
+        suffix = '.sav'
+        if self.compression() is None:
+            suffix = '_uncompressed.sav'
+        output_file = SpoolFile(addon.spool_directory, suffix,
+                                addon.spool_usage)
+        try:
+            self.render(output_file, product)
+            size = output_file.rewind()
+        except:
+            output_file.close()
+            raise
+        self.timings.phase('encoding').bytes += size
+        return output_file
+
+    def render(self, output_file, product):
+        if context.app.htsql_spss.writer == 'native':
+            return self.render_native(output_file, product)
+        from .savwriter import CustomSavWriter
+        sav_config = self.sav_config(product)
+        writer_kwargs = {
+            'savFileName': output_file.path,
+            'varNames': sav_config['var_names'],
+            'varTypes': sav_config['var_types'],
+            'formats': sav_config['formats'],
+            'columnWidths': sav_config['column_widths'],
+            'valueLabels': sav_config['value_labels'] or None,
+            'ioUtf8': True
+        }
+
+        with CustomSavWriter(**writer_kwargs) as writer:
+            for batch in self.write_batches(writer, product, output_file):
+                pass
+        output_file.reopen()
+
+    def render_native(self, output_file, product):
+        # The number of streamed records is patched into the header
+        # once they are all written.
+        sav_config = self.sav_config(product)
+        ncases = product.count(self.data)
+        writer = SAVWriter(output_file.file,
+                           sav_config['var_names'],
+                           sav_config['var_types'],
+                           formats=sav_config['formats'],
+                           column_widths=sav_config['column_widths'],
+                           value_labels=sav_config['value_labels'],
+                           ncases=ncases,
+                           compression=self.compression(),
+                           **self.parallel_encoding(sav_config))
+        self.preallocate(output_file, writer, ncases)
+        with writer:
+            for batch in self.write_batches(writer, product, output_file):
+                pass
+
+    def preallocate(self, output_file, writer, ncases):
+        # With a known number of cases, reserves the largest size the
+        # file could take: every value stored uncompressed, plus the
+        # command bytes when compressed.  The rest is dropped once the
+        # file is written.
+        if not context.app.htsql_spss.spool_preallocate or ncases < 0:
+            return
+        size = ncases * writer.case_size * 8
+        if writer.compression is not None:
+            size += size // 8
+        output_file.preallocate(output_file.file.tell() + size)
+
+
+class ServiceUnavailableError(HTTPError):
+    # The spool has no room for the file; the export could be retried.
+    status = "503 Service Unavailable"
+
 
-    def render(self, stream, product):
-        output_file, output_path = tempfile.mkstemp(suffix='.sav')
+class RenderSPSS(RenderFormat):
+    """
+    Streams the records of flat queries from the database to the SPSS
+    formatters in batches of `fetch_size` rows instead of loading the
+    whole result first, and queues asynchronous exports.
+
+    Only queries producing a single SQL statement whose variable widths
+    are known without a pass over the data are streamed.  Other queries
+    of a single statement with flat records are loaded as columns of
+    field values, without building the records.
+
+    With `result_cache_size` set, rendered files are cached and served
+    with validators for conditional requests.
+
+    The phases of every export are timed; with `server_timing` set, the
+    file is rendered before the response starts so that the timings could
+    be sent in a ``Server-Timing`` header.
+
+    Files rendered to the spool are rendered before the response starts
+    and handed to ``wsgi.file_wrapper`` when the server provides it; a
+    file over the `spool_quota` gets ``503 Service Unavailable``.
+    """
+
+    adapt(FormatCmd, RenderAction)
+
+    def __call__(self):
+        if isinstance(self.command.format, ExportFormat):
+            return self.submit()
+        if context.app.htsql_spss.result_cache_size and \
+                isinstance(self.command.format, SPSSFormat) and \
+                hasattr(self.command.feed, 'syntax'):
+            return self.render_cached()
+        return self.render()
+
+    def render(self):
+        format = self.command.format
+        if not isinstance(format, SPSSFormat):
+            return super(RenderSPSS, self).__call__()
+        format.timings = ExportTimings()
+        product = self.produce()
+        status = "200 OK"
+        headers = emit_headers(format, product)
+        emitter = Emit.__prepare__(format, product)
+        if context.app.htsql_spss.server_timing:
+            output_file = self.spool(emitter)
+            headers = headers + [('Server-Timing',
+                                  format.timings.server_timing())]
+        elif emitter.is_spooled():
+            output_file = self.spool(emitter)
+        else:
+            return (status, headers, emit(format, product))
+        return (status, headers, file_body(output_file, self.action.environ))
+
+    def produce(self):
+        # Single-statement queries are fetched here: streamed in batches
+        # of `fetch_size` rows if the widths are known up front, or
+        # loaded as columns if the records are flat.
+        query = self.command.format.timings.phase('query')
+        feed = self.command.feed
+        if isinstance(feed, DefaultCmd):
+            feed = FetchCmd(feed.syntax)
+        if not isinstance(feed, FetchCmd):
+            with query:
+                product = produce(self.command.feed)
+        else:
+            with query:
+                plan = analyze(feed)
+            meta = plan.profile.clone(plan=plan)
+            product = self.produce_flat(plan, meta)
+            if product is not None:
+                return product
+            with query:
+                product = FetchPipe(plan)()
+        if isinstance(product.data, (list, FetchedColumns)):
+            query.rows = len(product.data)
+        return product
+
+    def produce_flat(self, plan, meta):
+        if not self.is_single_statement(plan, meta):
+            return None
+        product_to_spss = to_spss(meta.domain, [meta])
+        fetch_size = context.app.htsql_spss.fetch_size
+        stream = FetchStream(plan, fetch_size or SPSS_FETCH_SIZE,
+                             map_columns(plan, product_to_spss))
+        if fetch_size and not product_to_spss.is_measured:
+            return Product(meta, stream)
+        if stream.field_columns is None:
+            return None
+        with self.command.format.timings.phase('query') as query:
+            data = stream.load()
+        query.rows = len(data)
+        return Product(meta, data)
+
+    def spool(self, emitter):
+        # Renders the whole file to the spool; streamed output is written
+        # there as it is produced, charged to the quota like other files.
+        # A file that cannot be completed is removed before the error
+        # response is sent.
+        addon = context.app.htsql_spss
         try:
-            sav_config = product.sav_config(self.data)
-            writer_kwargs = {
-                'savFileName': output_path,
-                'varNames': sav_config['var_names'],
-                'varTypes': sav_config['var_types'],
-                'formats': sav_config['formats'],
-                'columnWidths': sav_config['column_widths'],
-                'ioUtf8': True
-            }
-
-            with CustomSavWriter(**writer_kwargs) as writer:
-                for record in product.cells(self.data):
-                    writer.writerow(record)
-
-            with open(output_path, 'rb') as output_file:
-                while True:
-                    chunk = output_file.read(1024*1024)
-                    if chunk:
-                        stream.write(chunk)
-                    else:
-                        break
-        finally:
-            os.remove(output_path)
-
-class CustomSavWriter(savReaderWriter.SavWriter):
-    """Override of the default SavWriter class that modifies _pyWriteRow to
-    dump None as '' rather than 'None'.
+            if emitter.is_spooled():
+                return emitter.spool_file()
+            output_file = SpoolFile(addon.spool_directory, '.sav',
+                                    addon.spool_usage)
+            try:
+                for chunk in emitter():
+                    output_file.file.write(chunk)
+                    output_file.settle()
+                output_file.rewind()
+            except:
+                output_file.close()
+                raise
+            return output_file
+        except SpoolQuotaError, exc:
+            raise ServiceUnavailableError(str(exc))
+        except EncodingError, exc:
+            raise InternalServerError(str(exc))
+
+    def is_single_statement(self, plan, meta):
+        statement = plan.statement
+        return (statement is not None and
+                not statement.substatements and
+                not statement.placeholders and
+                isinstance(meta.domain, ListDomain))
+
+    def submit(self):
+        # Queues the export and responds with the job status; errors in
+        # the query are reported right away.
+        analyze(self.command.feed)
+        app = context.app
+        env = Environment(**dict((name, getattr(context.env, name))
+                                 for name in app.variables))
+        env.connection = None
+        command = FormatCmd(self.command.feed, self.command.format.format())
+        environ = dict(self.action.environ)
+        environ.pop('HTTP_IF_NONE_MATCH', None)
+        environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+        environ.pop('wsgi.file_wrapper', None)
+
+        def render(output_file):
+            context.push(app, env)
+            try:
+                status, headers, body = act(command, RenderAction(environ))
+                for chunk in body:
+                    output_file.write(chunk)
+                return headers
+            finally:
+                context.pop(app)
+
+        export_queue = app.htsql_spss.export_queue
+        job = export_queue.submit(render, self.command.format.extension)
+        location = wsgiref.util.application_uri(self.action.environ)
+        location = "%s/spss_job('%s')" % (location.rstrip('/'), job.job_id)
+        return render_job_status("202 Accepted", job, [('Location', location)])
+
+    def render_cached(self):
+        result_cache = context.app.htsql_spss.result_cache
+        key = self.cache_key()
+        etag = '"%s"' % key
+        entry = result_cache.get(key)
+        if entry is not None:
+            validators = [
+                ('ETag', etag),
+                ('Last-Modified',
+                 email.utils.formatdate(entry.last_modified, usegmt=True)),
+            ]
+            if self.is_not_modified(etag, entry.last_modified):
+                return ("304 Not Modified", validators, [])
+            # Opened right away so that an eviction does not affect us.
+            output_file = open(entry.path, 'rb')
+            return ("200 OK", entry.headers + validators,
+                    file_body(output_file, self.action.environ))
+        format = self.command.format
+        format.etag = etag
+        format.last_modified = int(time.time())
+        status, headers, body = self.render()
+        cache_headers = [(header, value) for header, value in headers
+                         if header in ('Content-Type', 'Content-Disposition')]
+        cache_writer = result_cache.open(key, cache_headers,
+                                         format.last_modified)
+        return (status, headers, cache_body(body, cache_writer))
+
+    def cache_key(self):
+        # Identifies the output by the query, the settings affecting it
+        # and the version of the data.  Every setting that changes the
+        # bytes of the file must be part of the key: cached files are
+        # kept on disk across restarts and may be shared by applications.
+        app = context.app
+        addon = app.htsql_spss
+        variables = [(name, getattr(context.env, name))
+                     for name in sorted(app.variables)]
+        variables = [(name, value) for name, value in variables
+                     if isinstance(value, (bool, int, long, str, unicode))]
+        parts = [
+            str(app.htsql.db),
+            unicode(self.command.feed.syntax),
+            self.command.format.__class__.__name__,
+            addon.writer,
+            addon.compression,
+            addon.schema_widths,
+            addon.coded_values,
+            variables,
+            fetch_data_version(),
+        ]
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def is_not_modified(self, etag, last_modified):
+        environ = self.action.environ
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            tags = [tag.strip()
+                    for tag in environ['HTTP_IF_NONE_MATCH'].split(',')]
+            return (etag in tags or '*' in tags)
+        if 'HTTP_IF_MODIFIED_SINCE' in environ:
+            since = email.utils.parsedate_tz(environ['HTTP_IF_MODIFIED_SINCE'])
+            if since is not None:
+                return (last_modified <= email.utils.mktime_tz(since))
+        return False
+
+
+def report_timings(timings):
+    # Logs the timings of an export and passes them to the timing hook.
+    SPSS_LOGGER.debug("export timings: %s", timings)
+    callback = context.app.htsql_spss.timing_callback
+    if callback is not None:
+        callback(timings)
+
+
+def fetch_data_version():
+    # Runs the `data_version` query.
+    sql = context.app.htsql_spss.data_version
+    if sql is None:
+        return None
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        row = cursor.fetchone()
+        cursor.close()
+    if not row:
+        return None
+    return row[0]
+
+
+def cache_body(body, cache_writer):
+    # Passes the body through, storing it in the cache once complete.
+    is_complete = False
+    try:
+        for chunk in body:
+            cache_writer.write(chunk)
+            yield chunk
+        is_complete = True
+    finally:
+        if is_complete:
+            cache_writer.commit()
+        else:
+            cache_writer.abort()
+
+
+def read_chunks(output_file):
+    with output_file:
+        while True:
+            chunk = output_file.read(SPSS_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def file_body(output_file, environ):
+    # Hands the file to the `wsgi.file_wrapper` of the server, which may
+    # send it with `sendfile()`; the server closes it once it is sent.
+    # Only requests coming through `make_wsgi_app()` get the wrapper:
+    # an HTSQL application iterating over the wrapper itself would not
+    # close it if the client went away.
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is None or SPSS_FILE_BODY_KEY not in environ:
+        return read_chunks(output_file)
+    body = file_wrapper(output_file, SPSS_CHUNK_SIZE)
+    environ[SPSS_FILE_BODY_KEY] = body
+    return body
+
+
+def make_wsgi_app(app):
+    """
+    Wraps an HTSQL application for a WSGI server.
+
+    An HTSQL application iterates over every response in its own
+    context, so the server never gets a file from ``wsgi.file_wrapper``.
+    The wrapped application returns such files to the server as they
+    are and iterates over other responses like the HTSQL application.
+    """
+    def application(environ, start_response):
+        environ[SPSS_FILE_BODY_KEY] = None
+        with app:
+            body = wsgi(environ, start_response)
+        if body is environ.get(SPSS_FILE_BODY_KEY):
+            return body
+        return iterate_body(app, body)
+    return application
+
+
+def iterate_body(app, body):
+    try:
+        with app:
+            for chunk in body:
+                yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def export_incremental(query, path, key):
+    """
+    Exports the records of an HTSQL query (without a format) to the
+    ``.sav`` file at `path` with the native writer.
+
+    The file left by a previous export of the same query is kept and
+    only the records whose `key` field is past the largest key exported
+    so far are appended to it.  The file is written anew if a string of
+    the new records does not fit the width of its variable.  The last
+    key, the variables and the size of the file are kept in
+    ``<path>.json``.  Records changed or deleted after they were exported
+    are not detected.
+
+    Must be called in the context of an HTSQL application.  Returns
+    ``'created'``, ``'appended'``, ``'rewritten'`` or ``'unchanged'``.
+    """
+    compression = context.app.htsql_spss.compression
+    if compression == 'none':
+        compression = None
+    state_path = path + '.json'
+    state = None
+    if os.path.exists(path) and os.path.exists(state_path):
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+        if (state['query'], state['key'], state['compression']) != \
+                (query, key, compression) or \
+                state['last_key'] is None or \
+                os.path.getsize(path) < state['size']:
+            state = None
+    if state is None:
+        write_export(query, path, key, compression)
+        return 'created'
+    product = produce('%s.filter(%s>$last_key)' % (query, key),
+                      last_key=state['last_key'])
+    if not product.data:
+        return 'unchanged'
+    product_to_spss = to_spss(product.meta.domain, [product.meta])
+    sav_config = product_to_spss.sav_config(product.data)
+    if sav_config['var_names'] != state['var_names'] or \
+            any((var_type == 0) != (state['var_types'][var_name] == 0) or
+                var_type > state['var_types'][var_name]
+                for var_name, var_type in sav_config['var_types'].items()):
+        write_export(query, path, key, compression)
+        return 'rewritten'
+    with open(path, 'r+b') as output_file:
+        # Drops whatever an interrupted export could have left.
+        output_file.truncate(state['size'])
+        output_file.seek(state['size'])
+        with SAVWriter(output_file,
+                       state['var_names'],
+                       state['var_types'],
+                       formats=state['formats'],
+                       column_widths=state['column_widths'],
+                       ncases=state['ncases'],
+                       compression=compression,
+                       append=True) as writer:
+            writer.writerows(product_to_spss.cells(product.data))
+        state['size'] = output_file.tell()
+    state['ncases'] = writer.case_count
+    state['last_key'] = find_last_key(product, key, state['last_key'])
+    save_export_state(state_path, state)
+    return 'appended'
+
+
+def write_export(query, path, key, compression):
+    # Writes the whole file of an incremental export and its state.
+    product = produce(query)
+    product_to_spss = to_spss(product.meta.domain, [product.meta])
+    sav_config = product_to_spss.sav_config(product.data)
+    last_key = find_last_key(product, key, None)
+    output_fd, output_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.part')
+    with os.fdopen(output_fd, 'wb') as output_file:
+        with SAVWriter(output_file,
+                       sav_config['var_names'],
+                       sav_config['var_types'],
+                       formats=sav_config['formats'],
+                       column_widths=sav_config['column_widths'],
+                       value_labels=sav_config['value_labels'],
+                       compression=compression) as writer:
+            writer.writerows(product_to_spss.cells(product.data))
+        size = output_file.tell()
+    os.rename(output_path, path)
+    state = {
+        'query': query,
+        'key': key,
+        'compression': compression,
+        'last_key': last_key,
+        'var_names': sav_config['var_names'],
+        'var_types': sav_config['var_types'],
+        'formats': sav_config['formats'],
+        'column_widths': sav_config['column_widths'],
+        'ncases': writer.case_count,
+        'size': size,
+    }
+    save_export_state(path + '.json', state)
+
+
+def find_last_key(product, key, last_key):
+    # The largest value of the key field, serialized.
+    fields = product.meta.domain.item_domain.fields
+    for idx, field in enumerate(fields):
+        if field.tag == key:
+            break
+    else:
+        raise ValueError("cannot find key field %r" % key)
+    values = [record[idx] for record in product.data
+              if record[idx] is not None]
+    if not values:
+        return last_key
+    return fields[idx].domain.dump(max(values))
+
+
+def save_export_state(state_path, state):
+    with open(state_path + '.part', 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(state_path + '.part', state_path)
+
+
+class FetchStream(object):
+    """
+    Iterates over the records of a single-statement plan, fetching rows
+    from the database in batches of `size`.
+
+    For flat records, `field_columns` gives the SQL column of every
+    field; the rows could then be fetched as batches of columns of field
+    values, without building the records.
     """
 
-    def _pyWriterow(self, record):
-        float_ = float
-        encoding = self.encoding
-        pad_string = self.pad_string
-        for i, value in enumerate(record):
-            varName = self.varNames[i]
-            varType = self.varTypes[varName]
-            if varType == 0:
-                try:
-                    value = float_(value)
-                except (ValueError, TypeError):
-                    value = self.sysmis_
-            else:
-                if value is None:
-                    value = ''
-                value = pad_string(value, varType)
-                if self.ioUtf8_ and isinstance(value, unicode):
-                    value = value.encode("utf-8")
-            record[i] = value
-        self.record = record
-
-    def writerow(self, record):
-        self._pyWriterow(record)
+    def __init__(self, plan, size, field_columns=None):
+        self.plan = plan
+        self.size = size
+        self.field_columns = field_columns
+
+    def __iter__(self):
+        compose = self.plan.compose
+        converts = [unscramble(domain)
+                    for domain in self.plan.statement.domains]
+        for rows in self.fetch():
+            rows = [tuple(convert(item)
+                          for item, convert in zip(row, converts))
+                    for row in rows]
+            for record in compose(None, RowStream(rows, [])):
+                yield record
+
+    def batches(self):
+        # Batches of columns of field values, one column for every field.
+        converts = []
+        for domain in self.plan.statement.domains:
+            convert = unscramble(domain)
+            if convert is Unscramble.convert:
+                convert = None
+            converts.append(convert)
+        for rows in self.fetch():
+            sql_columns = zip(*rows)
+            columns = []
+            for idx in self.field_columns:
+                convert = converts[idx]
+                if convert is None:
+                    columns.append(sql_columns[idx])
+                else:
+                    columns.append(map(convert, sql_columns[idx]))
+            yield columns
+
+    def load(self):
+        # Fetches all rows as columns of field values.
+        columns = [[] for idx in self.field_columns]
+        for batch in self.batches():
+            for column, values in zip(columns, batch):
+                column.extend(values)
+        return FetchedColumns(columns)
+
+    def fetch(self):
+        # Produces batches of raw rows.
+        if not context.env.can_read:
+            raise PermissionError("No read permissions")
+        statement = self.plan.statement
+        with transaction() as connection:
+            cursor = open_cursor(connection)
+            cursor.execute(statement.sql.encode('utf-8'))
+            while True:
+                rows = cursor.fetchmany(self.size)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+
+
+class FetchedColumns(object):
+    """
+    The records of a flat query as columns of field values, one column
+    for every field.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.length = len(columns[0])
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        # The records as tuples.
+        return itertools.izip(*self.columns)
+
+    def batches(self):
+        for start in range(0, self.length, SPSS_BATCH_SIZE):
+            yield [column[start:start+SPSS_BATCH_SIZE]
+                   for column in self.columns]
+
+
+def map_columns(plan, product_to_spss):
+    # Finds the SQL column of every field of flat records by composing
+    # a row of markers; None if some field is not a plain column.
+    item_to_spss = product_to_spss.item_to_spss
+    if not (isinstance(item_to_spss, RecordToSPSS) and
+            item_to_spss.is_flat and item_to_spss.fields_to_spss):
+        return None
+    markers = tuple(object() for domain in plan.statement.domains)
+    records = plan.compose(None, RowStream([markers], []))
+    if len(records) != 1:
+        return None
+    indexes = dict((id(marker), idx) for idx, marker in enumerate(markers))
+    field_columns = []
+    for value in records[0]:
+        if id(value) not in indexes:
+            return None
+        field_columns.append(indexes[id(value)])
+    if len(field_columns) != len(item_to_spss.fields_to_spss):
+        return None
+    return field_columns
+
+
+def open_cursor(connection):
+    # On PostgreSQL, a named cursor keeps the result on the server until
+    # it is fetched; other drivers use a regular cursor.
+    if context.app.htsql.db.engine == 'pgsql':
+        with connection.guard:
+            cursor = connection.connection.cursor('htsql_spss')
+        return CursorProxy(cursor, connection.guard)
+    return connection.cursor()
+
+
+class ChunkBuffer(object):
+    # Collects the output of the native writer between yields.
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ZSAVFormat(SPSSFormat):
+    pass
+
+
+class SummonZSAV(SummonFormat):
+    call('zsav')
+    format = ZSAVFormat
+
+
+class AcceptZSAV(Accept):
+    call(ZSAV_MIME_TYPE)
+    format = ZSAVFormat
+
+
+class EmitZSAVHeaders(EmitSPSSHeaders):
+    adapt(ZSAVFormat)
+
+    content_type = ZSAV_MIME_TYPE
+    file_extension = 'zsav'
+
+
+class EmitZSAV(EmitSPSS):
+    adapt(ZSAVFormat)
+
+    def __call__(self):
+        self.timings = self.format.timings or ExportTimings()
+        product = to_spss(self.meta.domain, [self.meta])
+        return self.report(self.spool(product))
+
+    def is_spooled(self):
+        return True
+
+    def compression(self):
+        return 'zlib'
+
+    def render(self, output_file, product):
+        sav_config = self.sav_config(product)
+        ncases = product.count(self.data)
+        writer = ZSAVWriter(output_file.file,
+                            sav_config['var_names'],
+                            sav_config['var_types'],
+                            formats=sav_config['formats'],
+                            column_widths=sav_config['column_widths'],
+                            value_labels=sav_config['value_labels'],
+                            ncases=ncases,
+                            threads=context.app.htsql_spss.zsav_threads,
+                            **self.parallel_encoding(sav_config))
+        self.preallocate(output_file, writer, ncases)
+        with writer:
+            for batch in self.write_batches(writer, product, output_file):
+                pass
+
+
+class ExportFormat(Format):
+    # Queues an export in `format` to be rendered in the background.
+    format = None
+    extension = None
+
+
+class ExportSPSSFormat(ExportFormat):
+    format = SPSSFormat
+    extension = 'sav'
+
+
+class ExportZSAVFormat(ExportFormat):
+    format = ZSAVFormat
+    extension = 'zsav'
+
+
+class SummonExportSPSS(SummonFormat):
+    call('spss_async')
+    format = ExportSPSSFormat
+
+
+class SummonExportZSAV(SummonFormat):
+    call('zsav_async')
+    format = ExportZSAVFormat
+
+
+class ExportJobCmd(Command):
+
+    def __init__(self, job_id):
+        assert isinstance(job_id, unicode)
+        self.job_id = job_id
+
+
+class SummonExportJob(Summon):
+    call('spss_job')
+
+    def __call__(self):
+        if len(self.arguments) != 1:
+            raise Error("Expected 1 argument")
+        [job_id] = self.arguments
+        if not isinstance(job_id, StringSyntax):
+            with recognize_guard(job_id):
+                raise Error("Expected a string literal")
+        return ExportJobCmd(job_id.text)
+
+
+class RenderExportJob(Act):
+    """
+    Serves the output of a finished export job, or its status while the
+    job is still pending or if it failed.
+    """
+
+    adapt(ExportJobCmd, RenderAction)
+
+    def __call__(self):
+        export_queue = context.app.htsql_spss.export_queue
+        job = export_queue.get(self.command.job_id.encode('utf-8'))
+        if job is None:
+            raise NotFoundError("unknown export job")
+        if job.state == 'failed':
+            return render_job_status("500 Internal Server Error", job)
+        if job.state != 'done':
+            return render_job_status("202 Accepted", job)
+        return ("200 OK", job.headers,
+                file_body(open(job.path, 'rb'), self.action.environ))
+
+
+def render_job_status(status, job, headers=()):
+    headers = [('Content-Type', 'application/json')] + list(headers)
+    return (status, headers, [json.dumps(job.status())])
@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+An on-disk cache of rendered files with size-bounded LRU eviction.
+
+Every entry is kept as two files in the cache directory: ``<key>.data``
+with the content and ``<key>.json`` with the HTTP headers describing it
+and the time it was rendered.  The entries are served as they are, so
+the directory must be private to the user running the application.
+"""
+
+import atexit
+import collections
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import uuid
+
+
+class CacheEntry(object):
+    """
+    A cached file.
+
+    `key`
+        The cache key.
+
+    `path`
+        The file with the content.
+
+    `headers`
+        The HTTP headers describing the content.
+
+    `last_modified`
+        The time the content was rendered, in seconds since the epoch.
+
+    `size`
+        The size of the content in bytes.
+    """
+
+    def __init__(self, key, path, headers, last_modified, size):
+        self.key = key
+        self.path = path
+        self.headers = headers
+        self.last_modified = last_modified
+        self.size = size
+
+
+class ResultCache(object):
+    """
+    Keeps at most `max_size` bytes of rendered files in `directory`.
+
+    Entries found in the directory are reused; the least recently used
+    entries are evicted first.  Without a `directory`, the entries are
+    kept in a private temporary directory removed when the process exits.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.is_loaded = False
+
+    def load(self):
+        # Picks up the entries left by previous processes, oldest first.
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='htsql_spss-cache-')
+            atexit.register(shutil.rmtree, self.directory, True)
+        elif not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0700)
+        check_directory(self.directory)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            path = os.path.join(self.directory, key + '.data')
+            try:
+                with open(os.path.join(self.directory, name)) as meta_file:
+                    meta = json.load(meta_file)
+                size = os.path.getsize(path)
+                atime = os.path.getatime(path)
+            except (IOError, OSError, ValueError):
+                continue
+            headers = [(str(header), str(value))
+                       for header, value in meta['headers']]
+            entries.append((atime, CacheEntry(key, path, headers,
+                                              meta['last_modified'], size)))
+        for atime, entry in sorted(entries, key=(lambda item: item[0])):
+            self.entries[entry.key] = entry
+            self.size += entry.size
+        self.is_loaded = True
+        self.evict()
+
+    def get(self, key):
+        with self.lock:
+            if not self.is_loaded:
+                self.load()
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+    def open(self, key, headers, last_modified):
+        # Returns a file-like object that adds an entry once committed.
+        with self.lock:
+            if not self.is_loaded:
+                self.load()
+        return CacheWriter(self, key, headers, last_modified)
+
+    def add(self, entry, partial_path):
+        with self.lock:
+            old_entry = self.entries.pop(entry.key, None)
+            if old_entry is not None:
+                self.size -= old_entry.size
+            os.rename(partial_path, entry.path)
+            with open(os.path.join(self.directory,
+                                   entry.key + '.json'), 'w') as meta_file:
+                json.dump({'headers': entry.headers,
+                           'last_modified': entry.last_modified}, meta_file)
+            self.entries[entry.key] = entry
+            self.size += entry.size
+            self.evict()
+
+    def evict(self):
+        while self.entries and self.size > self.max_size:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            for path in [entry.path,
+                         os.path.join(self.directory, key + '.json')]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class CacheWriter(object):
+    # Writes the content of a new entry to a temporary file.
+
+    def __init__(self, cache, key, headers, last_modified):
+        self.cache = cache
+        self.key = key
+        self.headers = headers
+        self.last_modified = last_modified
+        self.partial_path = os.path.join(
+                cache.directory, '%s.%s.part' % (key, uuid.uuid4().hex))
+        self.stream = open(self.partial_path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        self.stream.close()
+        if self.size > self.cache.max_size:
+            return self.abort()
+        path = os.path.join(self.cache.directory, self.key + '.data')
+        entry = CacheEntry(self.key, path, self.headers,
+                           self.last_modified, self.size)
+        self.cache.add(entry, self.partial_path)
+
+    def abort(self):
+        self.stream.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def check_directory(directory):
+    """
+    Raises `ValueError` unless `directory` is a directory owned by the
+    user of the process and not writable by other users.
+    """
+    status = os.lstat(directory)
+    if (not stat.S_ISDIR(status.st_mode) or
+            status.st_uid != os.getuid() or
+            status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise ValueError("unsafe directory %r" % directory)
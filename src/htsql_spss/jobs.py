@@ -0,0 +1,213 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+A queue of export jobs rendered in the background by a pool of worker
+threads.
+
+Every job writes its output to a file in a private directory; finished
+jobs are discarded with their files once they are older than the
+retention period.  Expired files are swept on a timer and, for files left
+by previous processes, when the directory is first used.
+"""
+
+import atexit
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from .cache import check_directory
+
+
+class ExportJob(object):
+    """
+    An export job.
+
+    `job_id`
+        The identifier of the job.
+
+    `path`
+        The file the output is written to.
+
+    `state`
+        One of ``'pending'``, ``'running'``, ``'done'`` or ``'failed'``.
+
+    `headers`
+        The HTTP headers describing the output when the job is done.
+
+    `error`
+        The error message when the job failed.
+
+    `size`
+        The size of the output charged to the spool quota.
+    """
+
+    def __init__(self, job_id, path):
+        self.job_id = job_id
+        self.path = path
+        self.state = 'pending'
+        self.headers = None
+        self.error = None
+        self.size = 0
+        self.created = time.time()
+        self.finished = None
+
+    def status(self):
+        status = {
+            'job': self.job_id,
+            'state': self.state,
+        }
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+
+class ExportQueue(object):
+    """
+    Runs export jobs on at most `workers` threads.
+
+    `retention`
+        The number of seconds a finished job is kept.
+
+    `directory`
+        The directory for the output, created private to the user of the
+        process; without it, the output is kept in a private temporary
+        directory removed when the process exits.
+
+    `quota`
+        The `SpoolQuota` the output of finished jobs is charged to.
+    """
+
+    def __init__(self, workers, retention, directory=None, quota=None):
+        self.workers = max(workers, 1)
+        self.retention = retention
+        self.directory = directory
+        self.quota = quota
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = None
+        self.timer = None
+        self.is_prepared = False
+
+    def prepare(self):
+        # Makes the directory and removes the expired files left in it;
+        # called with the lock held.
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='htsql_spss-jobs-')
+            atexit.register(shutil.rmtree, self.directory, True)
+        elif not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0700)
+        check_directory(self.directory)
+        atexit.register(self.close)
+        self.is_prepared = True
+        self.sweep()
+
+    def submit(self, render, extension):
+        # `render(output_file)` writes the output and returns its headers.
+        self.cleanup()
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            if not self.is_prepared:
+                self.prepare()
+            path = os.path.join(self.directory,
+                                'htsql_spss-%s.%s' % (job_id, extension))
+            job = ExportJob(job_id, path)
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(self.workers)
+            self.jobs[job_id] = job
+            self.pool.apply_async(self.run, (job, render))
+        return job
+
+    def run(self, job, render):
+        job.state = 'running'
+        partial_path = job.path + '.part'
+        try:
+            fd = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0600)
+            with os.fdopen(fd, 'wb') as output_file:
+                headers = render(output_file)
+            size = os.path.getsize(partial_path)
+            if self.quota is not None:
+                self.quota.charge(size)
+            job.size = size
+            os.rename(partial_path, job.path)
+            job.headers = headers
+            job.state = 'done'
+        except Exception, exc:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            job.error = str(exc) or exc.__class__.__name__
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+            self.schedule()
+
+    def get(self, job_id):
+        self.cleanup()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def schedule(self):
+        # Runs `cleanup()` once the retention period of the finished jobs
+        # is over.
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.retention + 1, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def close(self):
+        # Stops the timer of the cleanup.
+        with self.lock:
+            timer = self.timer
+            self.timer = None
+        if timer is not None:
+            timer.cancel()
+            timer.join()
+
+    def expire(self):
+        with self.lock:
+            self.timer = None
+            self.sweep()
+        self.cleanup()
+        with self.lock:
+            is_pending = any(job.finished is not None
+                             for job in self.jobs.values())
+        if is_pending:
+            self.schedule()
+
+    def cleanup(self):
+        # Discards the jobs that finished before the retention period.
+        deadline = time.time() - self.retention
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished is not None and job.finished < deadline]
+            for job in expired:
+                del self.jobs[job.job_id]
+        for job in expired:
+            if os.path.exists(job.path):
+                os.remove(job.path)
+            if self.quota is not None:
+                self.quota.release(job.size)
+            job.size = 0
+
+    def sweep(self):
+        # Removes the expired output of jobs of other processes, which
+        # are not known to this one; called with the lock held.
+        deadline = time.time() - self.retention
+        known = set(job.path for job in self.jobs.values())
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith('htsql_spss-') or path in known:
+                continue
+            try:
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,98 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Names of SPSS variables.
+
+Column names are sanitized and shortened to at most 63 characters by
+dropping stopwords; duplicate names get a numeric suffix.  The stopwords
+are loaded with the first name that is too long.
+"""
+
+import re
+import threading
+
+
+SPSS_MAX_NAME_LENGTH = 63
+COLUMN_ID_CACHE_SIZE = 65536
+
+_column_ids = {}
+_column_ids_lock = threading.Lock()
+
+
+def make_column_id(column_source):
+    """
+    Returns the variable name for a column; results are memoized.
+    """
+    try:
+        return _column_ids[column_source]
+    except KeyError:
+        pass
+    column_id = sanitize_name(column_source)
+    with _column_ids_lock:
+        if len(_column_ids) >= COLUMN_ID_CACHE_SIZE:
+            _column_ids.clear()
+        _column_ids[column_source] = column_id
+    return column_id
+
+
+def sanitize_name(column_source):
+    # sanitize all non-legal characters
+    column_id = re.sub('[^a-zA-Z0-9._$#@]', '_', column_source)
+    if len(column_id) > SPSS_MAX_NAME_LENGTH:
+        column_id = cut_column_name(column_id)
+    return column_id
+
+
+def cut_column_name(column_id):
+    # Drops the stopwords of the column name, then truncates.
+    from .stopwords import STOPWORDS
+    table_name, dot, column_name = column_id.rpartition('.')
+    column_name = '_'.join([word for word in column_name.split('_')
+                            if word not in STOPWORDS])
+    column_id = column_name
+    if table_name:
+        column_id = table_name + '.' + column_id
+    if len(column_id) > SPSS_MAX_NAME_LENGTH:
+        column_id = column_id[:SPSS_MAX_NAME_LENGTH-1]
+    return column_id
+
+
+class UniqueNames(object):
+    """
+    Allocates distinct variable names.
+
+    A taken name gets the first free suffix ``_1``, ``_2``, ...; the name
+    is truncated when the suffix would not fit.  The last suffix taken
+    for every name is remembered, so the search does not start over.
+    """
+
+    def __init__(self):
+        self.names = set()
+        self.suffixes = {}
+
+    def __contains__(self, name):
+        return (name in self.names)
+
+    def allocate(self, name):
+        names = self.names
+        if name not in names:
+            names.add(name)
+            return name
+        idx = self.suffixes.get(name, 1)
+        while True:
+            suffix = str(idx)
+            if len(name) + len(suffix) > SPSS_MAX_NAME_LENGTH:
+                name = name[:SPSS_MAX_NAME_LENGTH-len(suffix)]
+                if name not in names:
+                    names.add(name)
+                    return name
+                idx = self.suffixes.get(name, 1)
+                continue
+            new_name = name + '_' + suffix
+            if new_name not in names:
+                names.add(new_name)
+                self.suffixes[name] = idx
+                return new_name
+            idx += 1
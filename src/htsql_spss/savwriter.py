@@ -0,0 +1,89 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+The writer built on the IBM SPSS I/O library.
+
+The library and NumPy, which it loads, take a while to import, so this
+module is only imported once a file is rendered with the default writer.
+"""
+
+import ctypes
+import functools
+import itertools
+import struct
+
+import savReaderWriter
+
+from . import SPSS_BATCH_SIZE
+from .writer import ColumnMemo, encode_string
+
+
+class CustomSavWriter(savReaderWriter.SavWriter):
+    """Override of the default SavWriter class that encodes records in
+    batches and dumps None as '' rather than 'None'.
+
+    A converter for every variable is prepared once from the variable
+    types; each batch of records is converted column by column, with the
+    padded strings memoized, packed into one contiguous buffer and handed
+    to the I/O library case by case without further copying.
+    """
+
+    def __init__(self, *args, **kwds):
+        super(CustomSavWriter, self).__init__(*args, **kwds)
+        self.converters = [
+            self.make_converter(self.varTypes[var_name])
+            for var_name in self.varNames
+        ]
+        self.batch_structs = {}
+        self.wholeCaseOut.argtypes = [ctypes.c_int, ctypes.c_char_p]
+
+    def make_converter(self, var_type):
+        if var_type == 0:
+            def convert(value, float_=float, sysmis=self.sysmis_):
+                try:
+                    return float_(value)
+                except (ValueError, TypeError):
+                    return sysmis
+        else:
+            length = -8 * (var_type // -8)
+            def convert(value, width=var_type, length=length):
+                return encode_string(value, width).ljust(length)
+            return ColumnMemo(convert)
+        return functools.partial(map, convert)
+
+    def batch_struct(self, size):
+        if size not in self.batch_structs:
+            case_format = self.myStruct.format
+            self.batch_structs[size] = struct.Struct(
+                case_format[0] + case_format[1:] * size)
+        return self.batch_structs[size]
+
+    def write_batch(self, records):
+        columns = [convert(column)
+                   for convert, column in zip(self.converters, zip(*records))]
+        values = list(itertools.chain.from_iterable(itertools.izip(*columns)))
+        batch_struct = self.batch_struct(len(records))
+        batch_buffer = ctypes.create_string_buffer(batch_struct.size)
+        batch_struct.pack_into(batch_buffer, 0, *values)
+
+        case_size = self.myStruct.size
+        address = ctypes.addressof(batch_buffer)
+        for idx in range(len(records)):
+            retcode = self.wholeCaseOut(
+                self.fh, ctypes.c_char_p(address + idx * case_size))
+            if retcode:
+                savReaderWriter.error.checkErrsWarns(
+                    "Problem writing row", retcode)
+
+    def writerows(self, records):
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, SPSS_BATCH_SIZE))
+            if not batch:
+                break
+            self.write_batch(batch)
+
+    def writerow(self, record):
+        self.write_batch([record])
@@ -0,0 +1,160 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Temporary files of rendered exports.
+
+Files are created in the spool directory, which may be put on a fast
+file system such as a ``tmpfs`` mount.  The space they take is charged
+to a quota shared by all the renders of the process, so that concurrent
+exports fail early instead of filling the file system; the charge is
+released once a file is removed.
+"""
+
+import ctypes
+import os
+import tempfile
+import threading
+
+
+class SpoolQuotaError(Exception):
+    """
+    Raised when a file would take the spool over its quota.
+    """
+
+
+class SpoolQuota(object):
+    """
+    Counts the bytes taken by the files of the spool.
+
+    `limit`
+        The most bytes the files may take; ``0`` for no limit.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def charge(self, size):
+        with self.lock:
+            if self.limit and self.used + size > self.limit:
+                raise SpoolQuotaError("spool quota of %d bytes exceeded"
+                                      % self.limit)
+            self.used += size
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+
+class SpoolFile(object):
+    """
+    A temporary file of the spool, open for update.
+
+    The file is written through `file`, then rewound and read through
+    the same descriptor.  A library writing the file by its `path` may
+    replace it, so the file is reopened after it is written.  The file
+    is removed once closed or read to the end.
+    """
+
+    def __init__(self, directory=None, suffix='', quota=None):
+        fd, self.path = tempfile.mkstemp(suffix=suffix, dir=directory)
+        try:
+            self.file = os.fdopen(fd, 'w+b')
+        except:
+            os.close(fd)
+            os.remove(self.path)
+            raise
+        self.quota = quota
+        self.charged = 0
+        self.is_preallocated = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def preallocate(self, size):
+        # Reserves the expected size of the file, if the file system
+        # supports it.
+        if size <= self.charged:
+            return
+        self.charge(size - self.charged)
+        self.is_preallocated = preallocate(self.file.fileno(), size)
+
+    def settle(self):
+        # Charges the growth of the file beyond the reserved size.
+        size = os.path.getsize(self.path)
+        if size > self.charged:
+            self.charge(size - self.charged)
+
+    def charge(self, size):
+        if self.quota is not None:
+            self.quota.charge(size)
+        self.charged += size
+
+    def rewind(self):
+        # Drops the unused preallocated space and prepares the file for
+        # reading; returns the size of the file.
+        self.file.flush()
+        if self.is_preallocated:
+            self.file.truncate(self.file.tell())
+        size = os.path.getsize(self.path)
+        if size > self.charged:
+            self.charge(size - self.charged)
+        elif size < self.charged:
+            if self.quota is not None:
+                self.quota.release(self.charged - size)
+            self.charged = size
+        self.file.seek(0)
+        return size
+
+    def reopen(self):
+        self.file.close()
+        self.file = open(self.path, 'r+b')
+
+    def read(self, size=-1):
+        if self.file.closed:
+            return ''
+        data = self.file.read(size)
+        if not data:
+            self.close()
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.path)
+        if self.quota is not None:
+            self.quota.release(self.charged)
+        self.charged = 0
+
+
+def preallocate(fd, size):
+    # Allocates the blocks of the file with `posix_fallocate()`; returns
+    # whether the file was extended.
+    if _fallocate is None:
+        return False
+    return (_fallocate(fd, 0, size) == 0)
+
+
+def _load_fallocate():
+    # The symbols of the process include the C library; looking it up
+    # by name could run external tools.
+    try:
+        fallocate = ctypes.CDLL(None).posix_fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
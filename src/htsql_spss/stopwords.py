@@ -1,4 +1,4 @@
-STOPWORDS = [
+STOPWORDS = frozenset([
     "able",
     "about",
     "above",
@@ -638,4 +638,4 @@ STOPWORDS = [
     "yourselves",
     "you've",
     "zero"
-]
+])
@@ -0,0 +1,88 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Instrumentation of the phases of an export.
+
+An export goes through the query, the width scan (``sav_config``), the
+generation of the rows (``cells``), their encoding by the writer and the
+copy of the spooled file to the response.  Every phase records its wall
+time, the rows it processed, the bytes it produced and how much it raised
+the peak resident memory of the process.
+"""
+
+import collections
+import resource
+import time
+
+
+class Phase(object):
+    """
+    The measurements of a phase, accumulated over all its runs.
+
+    `name`
+        The name of the phase.
+
+    `duration`
+        The wall time in seconds.
+
+    `rows`
+        The number of records or cases processed.
+
+    `bytes`
+        The number of bytes produced.
+
+    `peak_memory`
+        The growth of the peak resident memory of the process in
+        kilobytes; other threads of the process contribute to it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_memory = 0
+        self.start = None
+        self.start_memory = None
+
+    def __enter__(self):
+        self.start_memory = peak_memory()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.duration += time.time() - self.start
+        self.peak_memory += peak_memory() - self.start_memory
+
+
+class ExportTimings(object):
+    """
+    The phases of an export, in the order they started.
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+
+    def phase(self, name):
+        # Returns the phase to time with a `with` block.
+        if name not in self.phases:
+            self.phases[name] = Phase(name)
+        return self.phases[name]
+
+    def server_timing(self):
+        # The value of a `Server-Timing` header, durations in milliseconds.
+        return ', '.join('%s;dur=%.1f' % (phase.name, phase.duration * 1000)
+                         for phase in self.phases.values())
+
+    def __str__(self):
+        return ', '.join('%s: %.3fs, %d rows, %d bytes, +%d KB'
+                         % (phase.name, phase.duration, phase.rows,
+                            phase.bytes, phase.peak_memory)
+                         for phase in self.phases.values())
+
+
+def peak_memory():
+    # The peak resident memory of the process in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
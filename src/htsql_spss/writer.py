@@ -0,0 +1,832 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+A pure-Python writer of IBM SPSS system (``.sav``) files.
+
+The writer emits the file header, the dictionary and the case data
+directly to any object with a ``write()`` method, so no temporary file
+and no vendor I/O library are needed.
+"""
+
+import collections
+import datetime
+import functools
+import itertools
+import multiprocessing.pool
+import re
+import struct
+import sys
+import zlib
+
+
+SAV_SYSMIS = -sys.float_info.max
+SAV_HIGHEST = sys.float_info.max
+SAV_LOWEST = struct.unpack('<d', '\xfe\xff\xff\xff\xff\xff\xef\xff')[0]
+SAV_BIAS = 100.0
+SAV_PRODUCT = '@(#) SPSS DATA FILE htsql_spss'
+SAV_CODEPAGE = 65001
+SAV_SEGMENT_WIDTH = 252
+SAV_MAX_SHORT_WIDTH = 255
+SAV_NCASES_OFFSET = 80
+SAV_BATCH_SIZE = 1024
+SAV_COMPRESSION_CODES = {None: 0, 'bytecode': 1, 'zlib': 2}
+SAV_ZLIB_BLOCK_SIZE = 0x3ff000
+SAV_ZLIB_LEVEL = 6
+SAV_CODE_PAD = 0
+SAV_CODE_LITERAL = 253
+SAV_CODE_SPACES = 254
+SAV_CODE_SYSMIS = 255
+SAV_SPACES = ' ' * 8
+SAV_MAX_LABEL_LENGTH = 120
+SAV_MAX_NAME_LENGTH = 64
+SAV_NAME_PATTERN = re.compile(r'\A(?:[^\W\d_]|@)[\w.$#@]*\Z', re.UNICODE)
+SAV_RESERVED_NAMES = frozenset(['ALL', 'AND', 'BY', 'EQ', 'GE', 'GT', 'LE',
+                                'LT', 'NE', 'NOT', 'OR', 'TO', 'WITH'])
+SAV_MEMO_SIZE = 4096
+SAV_MEMO_WINDOW = 8192
+
+SAV_FORMAT_TYPES = {
+    'A': 1,
+    'AHEX': 2,
+    'COMMA': 3,
+    'DOLLAR': 4,
+    'F': 5,
+    'E': 17,
+    'DATE': 20,
+    'TIME': 21,
+    'DATETIME': 22,
+    'ADATE': 23,
+    'JDATE': 24,
+    'DTIME': 25,
+}
+
+SAV_MEASURE_NOMINAL = 1
+SAV_MEASURE_SCALE = 3
+SAV_ALIGN_LEFT = 0
+SAV_ALIGN_RIGHT = 1
+
+
+class EncodingError(Exception):
+    """
+    Raised when a worker of the process pool fails to encode cases.
+    """
+
+
+def pack_format(format):
+    """
+    Packs a format specification such as ``F8.2`` or ``A10`` into the
+    integer used by variable records.
+    """
+    match = re.match(r'\A([A-Z]+)(\d+)(?:\.(\d+))?\Z', format)
+    if match is None or match.group(1) not in SAV_FORMAT_TYPES:
+        raise ValueError("unsupported format: %r" % format)
+    format_type = SAV_FORMAT_TYPES[match.group(1)]
+    width = int(match.group(2))
+    decimals = int(match.group(3) or 0)
+    return (format_type << 16) | (min(width, 255) << 8) | decimals
+
+
+def check_var_name(var_name):
+    """
+    Raises `ValueError` unless the name is accepted by the IBM I/O
+    library: at most 64 bytes starting with a letter or ``@``, made of
+    letters, digits and ``._$#@``, and not a reserved word.
+    """
+    if isinstance(var_name, str):
+        var_name = var_name.decode('utf-8')
+    if (len(var_name.encode('utf-8')) > SAV_MAX_NAME_LENGTH or
+            not SAV_NAME_PATTERN.match(var_name) or
+            var_name.upper() in SAV_RESERVED_NAMES):
+        raise ValueError("invalid variable name: %r" % var_name)
+
+
+def segment_widths(var_type):
+    """
+    Returns the widths of the segments that store a variable.
+
+    Numeric variables and strings up to 255 bytes take one segment;
+    a longer string takes one segment for every 252 bytes, each but the
+    last one holding 255 bytes of the value.  Like the IBM I/O library,
+    a last segment of exactly 252 bytes is also stored as 255 bytes.
+    """
+    if var_type <= SAV_MAX_SHORT_WIDTH:
+        return [var_type]
+    count = (var_type + SAV_SEGMENT_WIDTH - 1) // SAV_SEGMENT_WIDTH
+    last = var_type - SAV_SEGMENT_WIDTH * (count - 1)
+    if last == SAV_SEGMENT_WIDTH:
+        last = SAV_MAX_SHORT_WIDTH
+    return [SAV_MAX_SHORT_WIDTH] * (count - 1) + [last]
+
+
+def slot_count(width):
+    # The number of 8-byte units a segment of the given width occupies.
+    if width == 0:
+        return 1
+    return (width + 7) // 8
+
+
+def storage_width(var_type):
+    # The number of bytes a string variable occupies in a case.
+    return sum(slot_count(width) * 8 for width in segment_widths(var_type))
+
+
+def case_format(var_types):
+    # The `struct` format of the given variables in a case.
+    return ''.join('d' if var_type == 0 else '%ds' % storage_width(var_type)
+                   for var_type in var_types)
+
+
+def make_converter(var_type):
+    """
+    Returns a function converting a value of a variable to what is stored
+    in a case: a float for numeric variables or a string padded to the
+    storage width.
+    """
+    if var_type == 0:
+        def convert(value, float_=float, sysmis=SAV_SYSMIS):
+            try:
+                value = float_(value)
+            except (ValueError, TypeError):
+                return sysmis
+            # Not zero only for NaN and infinite values.
+            if value - value:
+                return sysmis
+            return value
+        return convert
+    widths = segment_widths(var_type)
+    if len(widths) == 1:
+        length = slot_count(var_type) * 8
+        def convert(value, width=var_type, length=length):
+            value = encode_string(value, width)
+            return value.ljust(length)
+        return convert
+    pieces = []
+    start = 0
+    for width in widths:
+        pieces.append((start, start + width, slot_count(width) * 8))
+        start += width
+    def convert(value, width=var_type, pieces=pieces):
+        value = encode_string(value, width)
+        return ''.join(value[start:end].ljust(length)
+                       for start, end, length in pieces)
+    return convert
+
+
+def column_converter(var_type):
+    """
+    Returns a function converting a column of values of a variable; the
+    stored form of string values is memoized.
+    """
+    convert = make_converter(var_type)
+    if var_type == 0:
+        return functools.partial(map, convert)
+    return ColumnMemo(convert)
+
+
+class ColumnMemo(object):
+    """
+    Converts the values of a column with `convert`, keeping the results
+    for at most `size` distinct values.
+
+    The hit rate is checked every `window` values; if fewer than half of
+    them were found in the memo, the memo is dropped and the values are
+    converted one by one from then on.
+    """
+
+    def __init__(self, convert, size=SAV_MEMO_SIZE, window=SAV_MEMO_WINDOW):
+        self.convert = convert
+        self.window = window
+        self.memo = Memo(convert, size)
+        self.calls = 0
+
+    def __call__(self, values):
+        # Converts a list of values.
+        memo = self.memo
+        if memo is None:
+            return map(self.convert, values)
+        results = map(memo.__getitem__, values)
+        self.tally(len(values))
+        return results
+
+    def get(self, value):
+        # Converts a single value.
+        memo = self.memo
+        if memo is None:
+            return self.convert(value)
+        result = memo[value]
+        self.tally(1)
+        return result
+
+    def tally(self, calls):
+        self.calls += calls
+        if self.calls < self.window:
+            return
+        if self.memo.misses * 2 > self.calls:
+            self.memo = None
+        else:
+            self.memo.misses = 0
+            self.calls = 0
+
+
+class Memo(dict):
+    # The results of `convert`, counting the values not found; new
+    # results are kept while there is room.  Only strings and `None` are
+    # kept as keys since equal numbers of different types, such as `1`
+    # and `True`, could convert differently.
+
+    def __init__(self, convert, size):
+        self.convert = convert
+        self.size = size
+        self.misses = 0
+
+    def __missing__(self, value):
+        self.misses += 1
+        result = self.convert(value)
+        if len(self) < self.size and \
+                (value is None or isinstance(value, basestring)):
+            self[value] = result
+        return result
+
+
+def compress_values(values, pack=struct.pack, float_=float, chr_=chr):
+    """
+    Encodes converted values with bytecode compression.
+
+    Returns a string with one compression code for every 8-byte unit and
+    a string with the literal values the codes refer to.
+    """
+    codes = []
+    literals = []
+    add_code = codes.append
+    add_literal = literals.append
+    lowest = -SAV_BIAS
+    highest = 251 - SAV_BIAS
+    sysmis_code = chr_(SAV_CODE_SYSMIS)
+    literal_code = chr_(SAV_CODE_LITERAL)
+    spaces_code = chr_(SAV_CODE_SPACES)
+    for value in values:
+        if value.__class__ is float_:
+            if value == SAV_SYSMIS:
+                add_code(sysmis_code)
+            elif lowest < value <= highest and value == int(value):
+                add_code(chr_(int(value + SAV_BIAS)))
+            else:
+                add_code(literal_code)
+                add_literal(pack('<d', value))
+        elif len(value) == 8:
+            if value == SAV_SPACES:
+                add_code(spaces_code)
+            else:
+                add_code(literal_code)
+                add_literal(value)
+        else:
+            for start in range(0, len(value), 8):
+                piece = value[start:start+8]
+                if piece == SAV_SPACES:
+                    add_code(spaces_code)
+                else:
+                    add_code(literal_code)
+                    add_literal(piece)
+    return ''.join(codes), ''.join(literals)
+
+
+def encode_columns(var_types, compression, columns):
+    """
+    Encodes the values of a group of variables, given column by column.
+
+    Returns the data of every case: a string for uncompressed files or
+    a pair of compression codes and literal values otherwise.
+    """
+    columns = [column_converter(var_type)(column)
+               for var_type, column in zip(var_types, columns)]
+    if compression is None:
+        case_struct = struct.Struct('<' + case_format(var_types))
+        return [case_struct.pack(*case) for case in zip(*columns)]
+    return [compress_values(case) for case in zip(*columns)]
+
+
+def encode_group(task):
+    # Runs `encode_columns()` in a worker process.
+    return encode_columns(*task)
+
+
+def encode_rows(var_types, compression, rows):
+    """
+    Encodes a range of cases.
+
+    Returns a string for uncompressed files or a pair of compression
+    codes and literal values otherwise.
+    """
+    converters = [make_converter(var_type) for var_type in var_types]
+    values = [convert(value)
+              for row in rows
+              for convert, value in zip(converters, row)]
+    if compression is None:
+        return struct.pack('<' + case_format(var_types) * len(rows), *values)
+    return compress_values(values)
+
+
+def encode_shard(task):
+    # Runs `encode_rows()` in a worker process.
+    return encode_rows(*task)
+
+
+class SAVWriter(object):
+    """
+    Writes an SPSS system file.
+
+    `stream`
+        A file-like object; only ``write()`` is required.  If the stream
+        is also seekable, the number of cases is patched into the header
+        when the writer is closed.
+
+    `var_names`
+        The list of variable names; see `check_var_name()`.
+
+    `var_types`
+        A dictionary mapping a variable name to ``0`` for numeric variables
+        or the width of a string variable in bytes.
+
+    `formats`
+        A dictionary mapping a variable name to its print/write format.
+
+    `column_widths`
+        A dictionary mapping a variable name to its display width.
+
+    `value_labels`
+        A dictionary mapping the name of a numeric variable to a
+        dictionary of its values and their labels.
+
+    `ncases`
+        The number of cases if known in advance, ``-1`` otherwise.
+
+    `compression`
+        ``None`` for uncompressed data or ``'bytecode'`` for the standard
+        SPSS compression.  Use `ZSAVWriter` for ``'zlib'``.
+
+    `pool`
+        A process pool to encode the case data of wide files; the
+        variables are split into `groups` groups encoded in parallel.
+
+    `shard_size`
+        If set, the cases are instead encoded on the `pool` in ranges of
+        this many cases, up to `shards` ranges at once, and written in
+        their order.
+
+    An exception raised in a worker of the `pool` is reported as
+    `EncodingError`; the cases it held are not written.
+
+    `append`
+        If set, the cases are added to a file written earlier with the
+        same variables and compression: `stream` must be seekable,
+        start with the file and be positioned at the end of its data,
+        and `ncases` is the number of cases the file holds.  The header
+        is patched when the writer is closed.
+    """
+
+    def __init__(self, stream, var_names, var_types, formats=None,
+                 column_widths=None, ncases=-1, compression=None,
+                 pool=None, groups=1, append=False, value_labels=None,
+                 shard_size=0, shards=1):
+        assert compression in SAV_COMPRESSION_CODES
+        assert not (append and compression == 'zlib')
+        for var_name in var_names:
+            check_var_name(var_name)
+        self.stream = stream
+        self.compression = compression
+        self.var_names = var_names
+        self.var_types = var_types
+        self.formats = formats or {}
+        self.column_widths = column_widths or {}
+        self.value_labels = value_labels or {}
+        self.ncases = ncases
+        self.case_count = 0
+        self.header_offset = None
+        if hasattr(stream, 'seek') and hasattr(stream, 'tell'):
+            try:
+                self.header_offset = stream.tell()
+            except (IOError, OSError):
+                self.header_offset = None
+
+        # One `(var_name, width, short_name)` triple for every segment.
+        self.segments = []
+        self.short_names = {}
+        used_names = set()
+        for var_name in var_names:
+            short_name = next(name for name in ('V%d' % idx
+                                                for idx in itertools.count(1))
+                              if name not in used_names)
+            used_names.add(short_name)
+            self.short_names[var_name] = short_name
+            widths = segment_widths(var_types[var_name])
+            self.segments.append((var_name, widths[0], short_name))
+            # Readers recognize the extra segments of a very long string
+            # by the first five characters of the variable name.
+            prefix = encode_string(var_name, 5).upper()
+            suffixes = itertools.count()
+            for width in widths[1:]:
+                short_name = next(name for name in ('%s%d' % (prefix, idx)
+                                                    for idx in suffixes)
+                                  if name not in used_names)
+                used_names.add(short_name)
+                self.segments.append((var_name, width, short_name))
+        self.case_size = sum(slot_count(width)
+                             for var_name, width, short_name in self.segments)
+
+        self.converters = [column_converter(var_types[var_name])
+                           for var_name in var_names]
+        self.case_format = case_format(var_types[var_name]
+                                       for var_name in var_names)
+        self.batch_structs = {}
+        self.is_closed = False
+        # Compression codes and literal values waiting for a full block.
+        self.pending_codes = ''
+        self.pending_literals = ''
+
+        # The types of the variables in every column group.
+        self.encoder_pool = pool
+        self.groups = []
+        if pool is not None and groups > 1:
+            for idx in range(groups):
+                start = len(var_names) * idx // groups
+                end = len(var_names) * (idx + 1) // groups
+                self.groups.append([var_types[var_name]
+                                    for var_name in var_names[start:end]])
+        # The cases of the next row shard and the shards being encoded.
+        self.shard_types = [var_types[var_name] for var_name in var_names]
+        self.shard_size = shard_size if pool is not None else 0
+        self.shards = max(shards, 1)
+        self.shard_rows = []
+        self.pending_shards = collections.deque()
+
+        if append:
+            if self.header_offset is None:
+                raise ValueError("a seekable stream is required")
+            self.header_offset = 0
+            self.case_count = ncases
+            self.ncases = -1
+            return
+        self.write_header()
+        self.write_dictionary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def batch_struct(self, size):
+        if size not in self.batch_structs:
+            self.batch_structs[size] = struct.Struct(
+                    '<' + self.case_format * size)
+        return self.batch_structs[size]
+
+    def write_header(self):
+        now = datetime.datetime.now()
+        creation_date = '%02d %s %02d' % (now.day, now.strftime('%b'),
+                                          now.year % 100)
+        creation_time = now.strftime('%H:%M:%S')
+        self.stream.write(struct.pack(
+                '<4s60siiiiid9s8s64s3s',
+                '$FL3' if self.compression == 'zlib' else '$FL2',
+                SAV_PRODUCT.ljust(60),
+                2,
+                self.case_size,
+                self.compression_code(),
+                0,
+                self.ncases,
+                SAV_BIAS,
+                creation_date,
+                creation_time,
+                ' ' * 64,
+                '\0' * 3))
+
+    def compression_code(self):
+        return SAV_COMPRESSION_CODES[self.compression]
+
+    def write_dictionary(self):
+        write = self.stream.write
+        # The position of the first record of every variable, from 1.
+        positions = {}
+        position = 1
+        for var_name, width, short_name in self.segments:
+            positions.setdefault(var_name, position)
+            if width == 0:
+                format = pack_format(self.formats.get(var_name, 'F8.2'))
+            else:
+                format = pack_format('A%d' % width)
+            write(struct.pack('<iiiiii8s', 2, width, 0, 0, format, format,
+                              short_name.ljust(8)))
+            for idx in range(slot_count(width) - 1):
+                write(struct.pack('<iiiiii8s', 2, -1, 0, 0, 0, 0, '\0' * 8))
+            position += slot_count(width)
+        self.write_value_labels(positions)
+
+        self.write_extension(3, 4, struct.pack(
+                '<8i', 20, 0, 0, -1, 1, 1, 2, SAV_CODEPAGE))
+        self.write_extension(4, 8, struct.pack(
+                '<3d', SAV_SYSMIS, SAV_HIGHEST, SAV_LOWEST))
+
+        display = []
+        for var_name, width, short_name in self.segments:
+            if width == 0:
+                display.extend([SAV_MEASURE_SCALE,
+                                self.column_widths.get(var_name, 8),
+                                SAV_ALIGN_RIGHT])
+            else:
+                display.extend([SAV_MEASURE_NOMINAL,
+                                self.column_widths.get(var_name, 8),
+                                SAV_ALIGN_LEFT])
+        self.write_extension(11, 4, struct.pack('<%di' % len(display),
+                                                *display))
+
+        long_names = '\t'.join(
+                '%s=%s' % (self.short_names[var_name],
+                           encode_string(var_name, 64))
+                for var_name in self.var_names)
+        self.write_extension(13, 1, long_names)
+
+        very_long_strings = ''.join(
+                '%s=%05d\0\t' % (self.short_names[var_name],
+                                 self.var_types[var_name])
+                for var_name in self.var_names
+                if self.var_types[var_name] > SAV_MAX_SHORT_WIDTH)
+        if very_long_strings:
+            self.write_extension(14, 1, very_long_strings)
+
+        self.write_extension(20, 1, 'UTF-8')
+        write(struct.pack('<ii', 999, 0))
+
+    def write_value_labels(self, positions):
+        # Variables with the same labels share a pair of a value label
+        # record and the record listing the variables.
+        label_sets = collections.OrderedDict()
+        for var_name in self.var_names:
+            labels = self.value_labels.get(var_name)
+            if labels and self.var_types[var_name] == 0:
+                key = tuple(sorted(labels.items()))
+                label_sets.setdefault(key, []).append(positions[var_name])
+        write = self.stream.write
+        for labels, var_positions in label_sets.items():
+            write(struct.pack('<ii', 3, len(labels)))
+            for value, label in labels:
+                label = encode_string(label, SAV_MAX_LABEL_LENGTH)
+                size = -8 * ((len(label) + 1) // -8)
+                write(struct.pack('<dB', value, len(label)))
+                write(label.ljust(size - 1, ' '))
+            write(struct.pack('<ii%di' % len(var_positions),
+                              4, len(var_positions), *var_positions))
+
+    def write_extension(self, subtype, size, data):
+        self.stream.write(struct.pack('<iiii', 7, subtype, size,
+                                      len(data) // size))
+        self.stream.write(data)
+
+    def write_data(self, data):
+        self.stream.write(data)
+
+    def writerows(self, records):
+        records = iter(records)
+        converters = self.converters
+        while True:
+            batch = list(itertools.islice(records, SAV_BATCH_SIZE))
+            if not batch:
+                break
+            if self.groups:
+                self.write_groups(batch)
+                self.case_count += len(batch)
+                continue
+            if self.shard_size:
+                self.write_shards(batch)
+                self.case_count += len(batch)
+                continue
+            # Converted column by column, then put back in case order.
+            columns = [convert(column)
+                       for convert, column in zip(converters, zip(*batch))]
+            values = list(itertools.chain.from_iterable(
+                    itertools.izip(*columns)))
+            if self.compression is None:
+                self.write_data(self.batch_struct(len(batch)).pack(*values))
+            else:
+                self.write_data(self.compress(values))
+            self.case_count += len(batch)
+
+    def writerow(self, record):
+        self.writerows([record])
+
+    def write_groups(self, batch):
+        # Encodes every column group on the process pool and stitches
+        # the encoded groups back into cases.
+        columns = zip(*batch)
+        tasks = []
+        start = 0
+        for var_types in self.groups:
+            end = start + len(var_types)
+            tasks.append((var_types, self.compression, columns[start:end]))
+            start = end
+        try:
+            groups = self.encoder_pool.map(encode_group, tasks)
+        except Exception, exc:
+            raise EncodingError("failed to encode cases: %s" % exc)
+        cases = zip(*groups)
+        if self.compression is None:
+            self.write_data(''.join(itertools.chain.from_iterable(cases)))
+            return
+        codes = ''.join(code for case in cases for code, literals in case)
+        literals = ''.join(literals for case in cases
+                           for code, literals in case)
+        self.write_data(self.assemble(codes, literals))
+
+    def write_shards(self, batch):
+        # Submits every full shard to the process pool; the encoded
+        # shards are written in order once too many are pending.
+        self.shard_rows.extend(batch)
+        while len(self.shard_rows) >= self.shard_size:
+            self.submit_shard(self.shard_rows[:self.shard_size])
+            del self.shard_rows[:self.shard_size]
+        while len(self.pending_shards) > self.shards or \
+                (self.pending_shards and self.pending_shards[0].ready()):
+            self.write_shard(self.collect_shard())
+
+    def submit_shard(self, rows):
+        self.pending_shards.append(self.encoder_pool.apply_async(
+                encode_shard, ((self.shard_types, self.compression, rows),)))
+
+    def collect_shard(self):
+        # Waits for the oldest pending shard; once a shard fails, the
+        # shards after it are dropped.
+        try:
+            return self.pending_shards.popleft().get()
+        except Exception, exc:
+            self.pending_shards.clear()
+            self.shard_rows = []
+            raise EncodingError("failed to encode cases: %s" % exc)
+
+    def write_shard(self, data):
+        if self.compression is None:
+            self.write_data(data)
+        else:
+            self.write_data(self.assemble(*data))
+
+    def compress(self, values):
+        return self.assemble(*compress_values(values))
+
+    def assemble(self, codes, literals):
+        # Every block of 8 compression codes is followed by the literal
+        # values it refers to; codes of an incomplete block wait for
+        # the next batch.
+        codes = self.pending_codes + codes
+        literals = self.pending_literals + literals
+        literal_code = chr(SAV_CODE_LITERAL)
+        size = len(codes) - len(codes) % 8
+        chunks = []
+        position = 0
+        for start in range(0, size, 8):
+            block = codes[start:start+8]
+            end = position + block.count(literal_code) * 8
+            chunks.append(block)
+            chunks.append(literals[position:end])
+            position = end
+        self.pending_codes = codes[size:]
+        self.pending_literals = literals[position:]
+        return ''.join(chunks)
+
+    def flush(self):
+        # Writes the pending shards, then pads and writes the last
+        # incomplete block of codes.
+        if self.shard_rows:
+            self.submit_shard(self.shard_rows)
+            self.shard_rows = []
+        while self.pending_shards:
+            self.write_shard(self.collect_shard())
+        if not self.pending_codes:
+            return
+        padding = 8 - len(self.pending_codes)
+        self.pending_codes += chr(SAV_CODE_PAD) * padding
+        self.write_data(self.assemble('', ''))
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.flush()
+        if self.ncases == -1 and self.header_offset is not None:
+            self.patch_ncases(self.case_count)
+
+    def patch_ncases(self, ncases):
+        position = self.stream.tell()
+        self.stream.seek(self.header_offset + SAV_NCASES_OFFSET)
+        self.stream.write(struct.pack('<i', ncases))
+        self.stream.seek(position)
+
+
+def encode_string(value, width):
+    # Encodes a string value in UTF-8 cutting it to at most `width` bytes
+    # without splitting a character.
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    if len(value) > width:
+        value = value[:width].decode('utf-8', 'ignore').encode('utf-8')
+    return value
+
+
+class ZSAVWriter(SAVWriter):
+    """
+    Writes a zlib-compressed SPSS system file (``.zsav``).
+
+    The bytecode-compressed case data is cut into blocks that are
+    compressed independently on a pool of `threads` threads.  The stream
+    must be seekable since the header of the data refers to the trailer
+    written when the writer is closed.
+    """
+
+    def __init__(self, stream, var_names, var_types, formats=None,
+                 column_widths=None, ncases=-1, threads=None,
+                 pool=None, groups=1, value_labels=None,
+                 shard_size=0, shards=1):
+        self.threads = threads or multiprocessing.cpu_count()
+        self.pool = multiprocessing.pool.ThreadPool(self.threads)
+        self.chunks = []
+        self.chunks_size = 0
+        self.blocks = []
+        # One `(uncompressed_size, compressed_size)` pair for every block.
+        self.block_sizes = []
+        super(ZSAVWriter, self).__init__(
+                stream, var_names, var_types, formats=formats,
+                column_widths=column_widths, ncases=ncases,
+                compression='zlib', pool=pool, groups=groups,
+                value_labels=value_labels, shard_size=shard_size,
+                shards=shards)
+        if self.header_offset is None:
+            raise ValueError("a seekable stream is required")
+
+    def write_dictionary(self):
+        super(ZSAVWriter, self).write_dictionary()
+        self.zheader_offset = self.stream.tell()
+        self.stream.write(struct.pack('<qqq', 0, 0, 0))
+
+    def write_data(self, data):
+        self.chunks.append(data)
+        self.chunks_size += len(data)
+        if self.chunks_size >= SAV_ZLIB_BLOCK_SIZE:
+            data = ''.join(self.chunks)
+            size = len(data) - len(data) % SAV_ZLIB_BLOCK_SIZE
+            for start in range(0, size, SAV_ZLIB_BLOCK_SIZE):
+                self.blocks.append(data[start:start+SAV_ZLIB_BLOCK_SIZE])
+            self.chunks = [data[size:]]
+            self.chunks_size = len(data) - size
+            if len(self.blocks) >= self.threads:
+                self.write_blocks()
+
+    def write_blocks(self):
+        # Compresses the pending blocks in parallel; `zlib` releases
+        # the GIL while compressing.
+        compressed_blocks = self.pool.map(compress_block, self.blocks)
+        for block, compressed_block in zip(self.blocks, compressed_blocks):
+            self.stream.write(compressed_block)
+            self.block_sizes.append((len(block), len(compressed_block)))
+        self.blocks = []
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.flush()
+        if self.chunks_size:
+            self.blocks.append(''.join(self.chunks))
+            self.chunks = []
+            self.chunks_size = 0
+        self.write_blocks()
+        self.pool.close()
+        self.pool.join()
+        self.write_trailer()
+        super(ZSAVWriter, self).close()
+
+    def write_trailer(self):
+        write = self.stream.write
+        ztrailer_offset = self.stream.tell()
+        zheader_offset = self.zheader_offset - self.header_offset
+        write(struct.pack('<qqii', -int(SAV_BIAS), 0, SAV_ZLIB_BLOCK_SIZE,
+                          len(self.block_sizes)))
+        uncompressed_offset = zheader_offset
+        compressed_offset = zheader_offset + 24
+        for uncompressed_size, compressed_size in self.block_sizes:
+            write(struct.pack('<qqii', uncompressed_offset, compressed_offset,
+                              uncompressed_size, compressed_size))
+            uncompressed_offset += uncompressed_size
+            compressed_offset += compressed_size
+        position = self.stream.tell()
+        self.stream.seek(self.zheader_offset)
+        write(struct.pack('<qqq', zheader_offset,
+                          ztrailer_offset - self.header_offset,
+                          position - ztrailer_offset))
+        self.stream.seek(position)
+
+
+def compress_block(block):
+    return zlib.compress(block, SAV_ZLIB_LEVEL)
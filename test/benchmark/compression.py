@@ -0,0 +1,108 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Compares the size and the time of uncompressed and bytecode-compressed
+output of the native writer.
+
+The records mimic the `tube` table of the test schema joined with its
+sample and individual, scaled up and widened with sparse columns::
+
+    python test/benchmark/compression.py [ROWS [SPARSE_COLUMNS]]
+"""
+
+import datetime
+import random
+import sys
+import time
+
+from htsql_spss.writer import SAVWriter, SAV_SYSMIS
+
+
+class CountingStream(object):
+    # Counts the bytes written without keeping them.
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def make_layout(sparse_columns):
+    var_names = ['individual.code', 'individual.sex', 'sample.code',
+                 'sample.contaminated', 'sample.date_collected',
+                 'tube.code', 'tube.volume_amount', 'tube.volume_unit',
+                 'tube.location_memo']
+    var_types = {'individual.code': 13, 'individual.sex': 6,
+                 'sample.code': 0, 'sample.contaminated': 5,
+                 'sample.date_collected': 0, 'tube.code': 0,
+                 'tube.volume_amount': 0, 'tube.volume_unit': 2,
+                 'tube.location_memo': 40}
+    formats = {'sample.code': 'F40', 'sample.date_collected': 'DATE11',
+               'tube.code': 'F40', 'tube.volume_amount': 'F40.16'}
+    for idx in range(sparse_columns):
+        var_name = 'extra.value_%d' % idx
+        var_names.append(var_name)
+        var_types[var_name] = 0 if idx % 2 else 8
+        if idx % 2:
+            formats[var_name] = 'F40'
+    return var_names, var_types, formats
+
+
+def make_records(count, var_names, var_types):
+    random.seed(0)
+    epoch = (datetime.datetime(2016, 1, 1) -
+             datetime.datetime(1582, 10, 14)).total_seconds()
+    extra = var_names[9:]
+    for idx in xrange(count):
+        record = [
+            'Q%02dH%04d' % (idx % 97, idx % 10000),
+            random.choice(['male', 'female', None]),
+            float(idx % 5 + 1),
+            random.choice(['true', 'false']),
+            epoch + 86400 * (idx % 365),
+            float(idx % 3 + 1),
+            round(random.random() * 10, 2),
+            random.choice(['ml', 'ul']),
+            None if idx % 4 else 'freezer %d' % (idx % 20),
+        ]
+        for var_name in extra:
+            if random.random() < 0.9:
+                record.append(SAV_SYSMIS if var_types[var_name] == 0
+                              else None)
+            elif var_types[var_name] == 0:
+                record.append(float(random.randint(0, 20)))
+            else:
+                record.append('C%d' % random.randint(0, 99))
+        yield record
+
+
+def measure(compression, count, sparse_columns):
+    var_names, var_types, formats = make_layout(sparse_columns)
+    stream = CountingStream()
+    start = time.time()
+    writer = SAVWriter(stream, var_names, var_types, formats=formats,
+                       ncases=count, compression=compression)
+    writer.writerows(make_records(count, var_names, var_types))
+    writer.close()
+    return stream.size, time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sparse_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    print "%d records, %d columns" % (count, 9 + sparse_columns)
+    baseline_size = None
+    for compression in [None, 'bytecode']:
+        size, elapsed = measure(compression, count, sparse_columns)
+        if baseline_size is None:
+            baseline_size = size
+        print "%-12s %12d bytes %8.2fs %6.2fx" % (
+                compression or 'none', size, elapsed,
+                float(baseline_size) / size)
+
+
+if __name__ == '__main__':
+    main()
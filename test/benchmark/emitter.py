@@ -0,0 +1,305 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Measures the SPSS emitter on synthetic data shaped like the individual,
+sample and tube tables of the test schema.
+
+For every shape and size, the product is built from HTSQL domains
+directly, so no database is queried (the application is configured with
+an in-memory SQLite address that is never opened; ``htsql_sqlite`` is
+required).  The report gives the time of the width scan (`sav_config`),
+of the row generation (`cells`) and of the whole output of `EmitSPSS`,
+the cases and bytes written per second and the peak memory of the
+process running the case, including the generated data.
+
+Measurements are compared with the baselines stored in ``emitter.json``
+with ``--check`` and recorded there with ``--save``.  Baselines depend
+on the machine; record them again before comparing on another one::
+
+    python test/benchmark/emitter.py [--rows 1000,10000,100000]
+                                     [--shapes narrow,wide,nested,text,numeric]
+                                     [--writer native] [--compression none]
+                                     [--check [--tolerance 0.25] | --save]
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+from htsql import HTSQL
+from htsql.core.domain import BooleanDomain, IntegerDomain, FloatDomain, \
+    DecimalDomain, TextDomain, EnumDomain, DateDomain, ListDomain, \
+    RecordDomain, Profile, Product
+from htsql.core.fmt.emit import emit
+from htsql_spss import to_spss, SPSSFormat
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'emitter.json')
+SHAPES = ['narrow', 'wide', 'nested', 'text', 'numeric']
+WIDE_COLUMNS = 200
+TEXT_COLUMNS = 20
+NUMERIC_COLUMNS = 40
+# Short cases are repeated for up to this many seconds; the best time
+# is reported.
+MIN_TIME = 1.0
+MAX_REPEATS = 5
+
+# The application the cases run with; set by `main()` before the worker
+# processes are forked.
+app = None
+
+
+def field(domain, table, column):
+    return Profile(domain, tag=unicode(column), path=None,
+                   header=u'%s.%s' % (table, column))
+
+
+def tube_fields():
+    return [
+        field(IntegerDomain(), 'tube', 'code'),
+        field(DecimalDomain(), 'tube', 'volume_amount'),
+        field(EnumDomain([u'ml', u'ul']), 'tube', 'volume_unit'),
+        field(TextDomain(), 'tube', 'location_memo'),
+    ]
+
+
+def tube_value(idx):
+    return (idx % 3 + 1,
+            decimal.Decimal(random.randint(0, 1000)) / 100,
+            random.choice([u'ml', u'ul']),
+            None if idx % 4 else u'Freezer %d' % (idx % 20))
+
+
+def make_narrow(count):
+    return tube_fields(), [tube_value(idx) for idx in xrange(count)]
+
+
+def make_wide(count):
+    # The tube columns followed by sparse numeric and text columns.
+    fields = tube_fields()
+    for idx in range(WIDE_COLUMNS):
+        domain = FloatDomain() if idx % 2 else TextDomain()
+        fields.append(field(domain, 'extra', 'value_%d' % idx))
+    records = []
+    for idx in xrange(count):
+        record = list(tube_value(idx))
+        for column in range(WIDE_COLUMNS):
+            if random.random() < 0.9:
+                record.append(None)
+            elif column % 2:
+                record.append(random.random() * 100)
+            else:
+                record.append(u'C%d' % random.randint(0, 99))
+        records.append(tuple(record))
+    return fields, records
+
+
+def make_nested(count):
+    # Individuals with up to three samples of up to two tubes each.
+    tube_domain = ListDomain(RecordDomain(tube_fields()))
+    sample_fields = [
+        field(IntegerDomain(), 'sample', 'code'),
+        field(BooleanDomain(), 'sample', 'contaminated'),
+        field(DateDomain(), 'sample', 'date_collected'),
+        Profile(tube_domain, tag=u'tube', path=None, header=u'tube'),
+    ]
+    sample_domain = ListDomain(RecordDomain(sample_fields))
+    fields = [
+        field(TextDomain(), 'individual', 'code'),
+        field(EnumDomain([u'male', u'female']), 'individual', 'sex'),
+        Profile(sample_domain, tag=u'sample', path=None, header=u'sample'),
+    ]
+    records = []
+    for idx in xrange(count):
+        samples = []
+        for sample_code in range(idx % 4):
+            tubes = [tube_value(idx + tube_code)
+                     for tube_code in range((idx + sample_code) % 3)]
+            samples.append((sample_code + 1, bool(sample_code % 2),
+                            datetime.date(2016, 6, sample_code + 1), tubes))
+        records.append((u'I%06d' % idx,
+                        random.choice([u'male', u'female', None]),
+                        samples))
+    return fields, records
+
+
+def make_text(count):
+    # Individuals described by free text columns of various lengths.
+    fields = [field(TextDomain(), 'individual', 'note_%d' % idx)
+              for idx in range(TEXT_COLUMNS)]
+    records = []
+    for idx in xrange(count):
+        records.append(tuple(
+                u'%s %d' % (u'note' * random.randint(0, 5 * column), idx)
+                if random.random() < 0.8 else None
+                for column in range(TEXT_COLUMNS)))
+    return fields, records
+
+
+def make_numeric(count):
+    # Measurements of integer, float, decimal and date columns.
+    domains = [IntegerDomain(), FloatDomain(), DecimalDomain(), DateDomain()]
+    fields = [field(domains[idx % 4], 'measure', 'value_%d' % idx)
+              for idx in range(NUMERIC_COLUMNS)]
+    epoch = datetime.date(2000, 1, 1)
+    records = []
+    for idx in xrange(count):
+        record = []
+        for column in range(NUMERIC_COLUMNS):
+            kind = column % 4
+            if kind == 0:
+                record.append(random.randint(0, 1000))
+            elif kind == 1:
+                record.append(random.random() * 1000)
+            elif kind == 2:
+                record.append(decimal.Decimal(random.randint(0, 10**6)) / 100)
+            else:
+                record.append(epoch +
+                              datetime.timedelta(days=random.randint(0, 9000)))
+        records.append(tuple(record))
+    return fields, records
+
+
+def make_product(shape, count):
+    random.seed(0)
+    fields, records = globals()['make_' + shape](count)
+    meta = Profile(ListDomain(RecordDomain(fields)), tag=None, path=None,
+                   header=None)
+    return Product(meta, records)
+
+
+def run_case(shape, count):
+    # Runs in a separate process so the peak memory is its own.
+    product = make_product(shape, count)
+    with app:
+        product_to_spss = to_spss(product.meta.domain, [product.meta])
+        start = time.time()
+        product_to_spss.sav_config(product.data)
+        sav_config_time = time.time() - start
+
+        product_to_spss = to_spss(product.meta.domain, [product.meta])
+        start = time.time()
+        cases = sum(1 for row in product_to_spss.cells(product.data))
+        cells_time = time.time() - start
+
+        emit_time = None
+        total_time = 0.0
+        for repeat in range(MAX_REPEATS):
+            start = time.time()
+            size = sum(len(chunk) for chunk in emit(SPSSFormat(), product))
+            elapsed = time.time() - start
+            emit_time = min(emit_time, elapsed) if emit_time else elapsed
+            total_time += elapsed
+            if total_time >= MIN_TIME:
+                break
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return {
+        'cases': cases,
+        'bytes': size,
+        'sav_config': sav_config_time,
+        'cells': cells_time,
+        'emit': emit_time,
+        'cases_per_sec': cases / max(emit_time, 1e-9),
+        'bytes_per_sec': size / max(emit_time, 1e-9),
+        'peak_mb': peak,
+    }
+
+
+def measure(shape, count):
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(run_case, (shape, count))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def check(key, result, baseline, tolerance):
+    # Returns the regressions of the result against its baseline.
+    problems = []
+    if result['cases_per_sec'] < baseline['cases_per_sec'] * (1 - tolerance):
+        problems.append("%s: %.0f cases/s, baseline %.0f" % (
+                key, result['cases_per_sec'], baseline['cases_per_sec']))
+    if result['peak_mb'] > baseline['peak_mb'] * (1 + tolerance):
+        problems.append("%s: %.1f MB peak, baseline %.1f" % (
+                key, result['peak_mb'], baseline['peak_mb']))
+    return problems
+
+
+def main():
+    global app
+    parser = argparse.ArgumentParser(description="SPSS emitter benchmarks")
+    parser.add_argument('--rows', default='1000,10000,100000',
+                        help="comma-separated numbers of records")
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help="comma-separated shapes: %s" % ', '.join(SHAPES))
+    parser.add_argument('--writer', default='savreaderwriter',
+                        choices=['savreaderwriter', 'native'])
+    parser.add_argument('--compression', default='bytecode',
+                        choices=['none', 'bytecode'])
+    parser.add_argument('--check', action='store_true',
+                        help="compare with the stored baselines")
+    parser.add_argument('--save', action='store_true',
+                        help="store the results as baselines")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed slowdown or memory growth")
+    args = parser.parse_args()
+    shapes = args.shapes.split(',')
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error("unknown shape: %s" % shape)
+    counts = [int(count) for count in args.rows.split(',')]
+
+    app = HTSQL({'engine': 'sqlite', 'database': ':memory:'},
+                {'htsql_spss': {'writer': args.writer,
+                                'compression': args.compression}})
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baseline_file:
+            baselines = json.load(baseline_file)
+
+    print "%-8s %9s %9s %9s %9s %9s %11s %11s %8s" % (
+            'shape', 'rows', 'cases', 'scan', 'cells', 'emit',
+            'cases/s', 'MB/s', 'peak MB')
+    problems = []
+    for shape in shapes:
+        for count in counts:
+            result = measure(shape, count)
+            print "%-8s %9d %9d %8.2fs %8.2fs %8.2fs %11.0f %11.2f %8.1f" % (
+                    shape, count, result['cases'], result['sav_config'],
+                    result['cells'], result['emit'], result['cases_per_sec'],
+                    result['bytes_per_sec'] / 2**20, result['peak_mb'])
+            key = '%s/%s/%s/%d' % (args.writer, args.compression,
+                                   shape, count)
+            if args.check and key in baselines:
+                problems.extend(check(key, result, baselines[key],
+                                      args.tolerance))
+            if args.save:
+                baselines[key] = {
+                    'cases_per_sec': round(result['cases_per_sec']),
+                    'peak_mb': round(result['peak_mb'], 1),
+                }
+
+    if args.save:
+        with open(BASELINE_PATH, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            baseline_file.write('\n')
+    for problem in problems:
+        print "REGRESSION", problem
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
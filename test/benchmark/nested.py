@@ -0,0 +1,134 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Times the rows produced for a three-level nested query by the flattening
+plan against the nested generators it replaced.
+
+The query runs on a temporary SQLite copy of the individual, sample and
+tube tables of the test schema, scaled up; it requires ``htsql_sqlite``::
+
+    python test/benchmark/nested.py [INDIVIDUALS]
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from htsql import HTSQL
+from htsql_spss import to_spss, RecordToSPSS, ListToSPSS
+
+
+QUERY = ("/individual{code, sex,"
+         " /sample{code, contaminated, date_collected,"
+         " /tube{code, volume_amount, location_memo}}}")
+
+
+def make_database(path, count):
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE individual (
+            id integer PRIMARY KEY, code text NOT NULL UNIQUE, sex text);
+        CREATE TABLE sample (
+            id integer PRIMARY KEY,
+            individual_id integer NOT NULL REFERENCES individual(id),
+            code integer NOT NULL, contaminated boolean NOT NULL,
+            date_collected date,
+            UNIQUE (individual_id, code));
+        CREATE TABLE tube (
+            id integer PRIMARY KEY,
+            sample_id integer NOT NULL REFERENCES sample(id),
+            code integer NOT NULL, volume_amount real, location_memo text,
+            UNIQUE (sample_id, code));
+    """)
+    sample_id = 0
+    tube_id = 0
+    for idx in xrange(count):
+        connection.execute(
+                "INSERT INTO individual VALUES (?, ?, ?)",
+                (idx, 'I%06d' % idx, ['male', 'female', None][idx % 3]))
+        for sample_code in range(idx % 4):
+            sample_id += 1
+            connection.execute(
+                    "INSERT INTO sample VALUES (?, ?, ?, ?, ?)",
+                    (sample_id, idx, sample_code, sample_code % 2,
+                     '2016-06-%02d' % (sample_code + 1)))
+            for tube_code in range(sample_id % 3):
+                tube_id += 1
+                connection.execute(
+                        "INSERT INTO tube VALUES (?, ?, ?, ?, ?)",
+                        (tube_id, sample_id, tube_code, tube_code * 1.5,
+                         'Freezer %d' % tube_code))
+    connection.commit()
+    connection.close()
+
+
+def generator_cells(to_spss, value):
+    # The row generation the flattening plan replaced.
+    if isinstance(to_spss, ListToSPSS):
+        if value is None or not to_spss.width:
+            return
+        for item in value:
+            for row in generator_cells(to_spss.item_to_spss, item):
+                yield row
+    elif isinstance(to_spss, RecordToSPSS):
+        if not to_spss.width:
+            return
+        if value is None:
+            yield [None] * to_spss.width
+            return
+        cell_streams = [
+            (generator_cells(field_to_spss, field_value),
+             field_to_spss.width)
+            for field_value, field_to_spss
+            in zip(value, to_spss.fields_to_spss)
+        ]
+        is_done = False
+        while not is_done:
+            is_done = True
+            row = []
+            for cell_stream, field_width in cell_streams:
+                subrow = next(cell_stream, None)
+                if subrow is None:
+                    subrow = [None] * field_width
+                else:
+                    is_done = False
+                row.extend(subrow)
+            if not is_done:
+                yield row
+    else:
+        for row in to_spss.cells(value):
+            yield row
+
+
+def measure(app, cells):
+    product = app.produce(QUERY)
+    with app:
+        product_to_spss = to_spss(product.meta.domain, [product.meta])
+        start = time.time()
+        rows = list(cells(product_to_spss, product.data))
+        return len(rows), time.time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'nested.sqlite')
+        make_database(path, count)
+        app = HTSQL('sqlite:' + path, {'htsql_spss': None})
+        for name, cells in [
+                ('generators', generator_cells),
+                ('plan', lambda to_spss, data: to_spss.cells(data))]:
+            size, elapsed = measure(app, cells)
+            print "%-12s %8d rows %8.2fs" % (name, size, elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2016, Prometheus Research, LLC
+#
+
+"""
+Measures the time it takes to import ``htsql_spss`` and checks that the
+writer stack is not loaded with it.
+
+Every run imports HTSQL and then the addon in a fresh interpreter; the
+report gives the best and the median time of each over the runs.  The
+I/O library (``savReaderWriter``), NumPy and the stopwords are loaded
+with the first export, so the run fails if the import pulled any of them
+in, or if it took longer than ``--max-time`` seconds::
+
+    python test/benchmark/startup.py [--runs 10] [--max-time SECONDS]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ['numpy', 'savReaderWriter', 'htsql_spss.stopwords']
+
+RUN_SCRIPT = """
+import json, sys, time
+start = time.time()
+import htsql, htsql.core.fmt.emit
+middle = time.time()
+import htsql_spss
+end = time.time()
+print json.dumps({'htsql': middle - start, 'htsql_spss': end - middle,
+                  'modules': [name for name in %r if name in sys.modules]})
+""" % HEAVY_MODULES
+
+
+def run():
+    # Imports the addon in a new process.
+    output = subprocess.check_output([sys.executable, '-c', RUN_SCRIPT])
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import time benchmark")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="number of interpreters to start")
+    parser.add_argument('--max-time', type=float, default=None,
+                        help="longest allowed median import of the addon")
+    args = parser.parse_args()
+
+    results = [run() for idx in range(args.runs)]
+    print "%-12s %9s %9s" % ('module', 'best', 'median')
+    for name in ['htsql', 'htsql_spss']:
+        times = [result[name] for result in results]
+        print "%-12s %8.3fs %8.3fs" % (name, min(times), median(times))
+
+    problems = []
+    modules = sorted(set(name for result in results
+                         for name in result['modules']))
+    if modules:
+        problems.append("imported with the addon: %s" % ', '.join(modules))
+    addon_time = median([result['htsql_spss'] for result in results])
+    if args.max_time is not None and addon_time > args.max_time:
+        problems.append("median import %.3fs, allowed %.3fs"
+                        % (addon_time, args.max_time))
+    for problem in problems:
+        print "REGRESSION", problem
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()